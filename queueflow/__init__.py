@@ -3,12 +3,24 @@ import re
 #  from tblib import pickling_support
 from torch import multiprocessing as mp
 
+from .async_step import AsyncStep
+from .byte_queue import ByteQueue, ResizableQueue
+from .cache import DiskCache
+from .collate import default_collate
+from .errors import DeadLetter
+from .handlers import register_handler
 from .in_out import InputStep, OutputStep
+from .ownership import UseAfterPutError
 from .pack import PackStep, RepackStep, UnpackStep
+from .parallel import Parallel
+from .remote import RemoteStep
 from .pool import PoolStep
 from .process_step import ProcessStep
 from .sequence import Sequence
+from .shm_queue import ShmQueue
+from .shutdown_event import ShutdownEvent
 from .step_base import StepBase
+from .thread_step import ThreadQueue, ThreadStep
 
 #  pickling_support.install()
 
@@ -29,7 +41,7 @@ def init(file_descriptor: bool = True):
         mp.set_sharing_strategy("file_system")
 
 
-shutdown_event = mp.Event()
+shutdown_event = ShutdownEvent()
 # Provide the constructors of all classes
 # with a global shutdown event
 def shutdown_wrapper(f):
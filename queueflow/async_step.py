@@ -0,0 +1,197 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.queues import Empty
+
+from torch import multiprocessing as mp
+
+from .errors import call_with_retries_async
+from .logger import logger
+from .ordering import EpochGate
+from .shutdown_event import wait_readable
+from .step_base import StepBase
+from .terminate_queue import TerminateQueue
+
+
+class AsyncStep(StepBase):
+    """Processing step for `async def` worker functions.
+    Each of the `nworkers` processes runs an event loop that processes
+    up to `concurrency` elements at the same time, eg. to fetch data
+    from remote services without a process per request.
+
+    The outputs are put as soon as they are ready. With `ordered`
+    they are put in the order of the inputs, which requires a single
+    worker process. A `Sequence` or `Parallel` that switches its steps
+    to the ordered mode raises a ValueError for an AsyncStep with more
+    workers."""
+
+    def __init__(
+        self,
+        *args,
+        concurrency: int = 16,
+        ordered: bool = False,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        if not asyncio.iscoroutinefunction(self.workerfn):
+            raise TypeError("The worker function of an AsyncStep must be async.")
+        assert concurrency >= 1
+        self.concurrency = concurrency
+        self.ordered = ordered
+        # Same protocol for the terminal element as in `ProcessStep`
+        self.dequeue_lock = mp.Lock()
+        self.epoch_gate = EpochGate()
+
+    @property
+    def ordered(self) -> bool:
+        return self._ordered
+
+    @ordered.setter
+    def ordered(self, ordered: bool):
+        # Checked when the step is set up, not when the sequence starts
+        if ordered and self.nworkers > 1:
+            raise ValueError(f"{self.name}: ordered AsyncStep needs nworkers=1.")
+        self._ordered = ordered
+
+    def inputs_complete(self, n_outputs: int) -> int:
+        if self.on_error != "raise" or not (
+            self.ordered or (self.nworkers == 1 and self.concurrency == 1)
+        ):
+            return super().inputs_complete(n_outputs)
+        return n_outputs
+
+    def _worker(self, shutdown_event):
+        self.set_workername()
+        logger.debug(
+            f"""\
+{self.workername} start event loop with concurrency {self.concurrency}."""
+        )
+        try:
+            asyncio.run(self.__run(shutdown_event))
+        except KeyboardInterrupt:
+            pass
+        self._close_queues()
+
+    async def __run(self, shutdown_event):
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        # Task of the previous element, awaited before the put in the ordered mode
+        previous = None
+        # Set if an element failed with on_error="raise", the worker stops
+        self._failed = False
+        # Threads for the outputs waiting for the terminal element of the
+        # previous epoch, so they do not take the threads the puts need
+        self._gate_waiter = ThreadPoolExecutor(self.concurrency)
+        while not shutdown_event.is_set() and not self._failed:
+            await slots.acquire()
+            try:
+                wkin, epoch = await self.__dequeue(shutdown_event)
+            except Empty:
+                slots.release()
+                continue
+            # The terminal element is put by the `EpochGate`
+            if isinstance(wkin, TerminateQueue):
+                slots.release()
+                logger.debug(
+                    f"{self.workername} took terminal element of epoch {wkin.epoch}."
+                )
+                continue
+            self.count_in += 1
+            task = asyncio.create_task(self.__process(wkin, epoch, previous, slots))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            if self.ordered:
+                previous = task
+        for task in tasks:
+            task.cancel()
+        self._gate_waiter.shutdown(wait=False)
+
+    async def __dequeue(self, shutdown_event):
+        """Take the next element from the input queue without blocking the
+        event loop, returns the element and its epoch."""
+        start = time.perf_counter()
+        # Only the time the queue was empty counts as blocked
+        blocked = False
+        try:
+            while not shutdown_event.is_set():
+                with self.dequeue_lock:
+                    try:
+                        wkin = self.inq.get(block=False)
+                    except Empty:
+                        wkin = None
+                    if wkin is not None:
+                        epoch, terminals = self.epoch_gate.take(wkin, shutdown_event)
+                if isinstance(wkin, TerminateQueue):
+                    # The put blocks while the output queue is full
+                    await asyncio.get_running_loop().run_in_executor(
+                        None,
+                        self.epoch_gate.put_terminals,
+                        terminals,
+                        self.__put_terminal,
+                    )
+                    return wkin, epoch
+                if wkin is not None:
+                    self.metrics.add(items_in=1)
+                    return self._take_ownership(wkin), epoch
+                blocked = True
+                await wait_readable(self.inq, shutdown_event, timeout=1)
+            raise Empty
+        finally:
+            if blocked:
+                self.metrics.add(get_blocked_time=time.perf_counter() - start)
+
+    async def __process(self, wkin, epoch, previous, slots):
+        loop = asyncio.get_running_loop()
+        try:
+            key, hit, wkout = self._cache_lookup(wkin)
+            dropped = False
+            if not hit:
+                start = time.perf_counter()
+                try:
+                    wkout = await call_with_retries_async(
+                        self.workerfn, self.retries, wkin
+                    )
+                # Catch Errors in the worker function
+                except Exception as error:
+                    if not self._drop(error, wkin):
+                        self._failed = True
+                        return
+                    dropped = True
+                if not dropped:
+                    self.metrics.add(work_time=time.perf_counter() - start)
+                    self._trace("work", start)
+                    self._cache_store(key, wkout)
+            if previous is not None:
+                await asyncio.wait([previous])
+            # Outputs of the next epoch wait for the terminal element
+            if not self.epoch_gate.is_open(epoch):
+                if not await loop.run_in_executor(
+                    self._gate_waiter,
+                    self.epoch_gate.wait_epoch,
+                    epoch,
+                    self.shutdown_event,
+                ):
+                    return
+            logger.debug(
+                f"""\
+{self.workername} push output of type {type(wkout)} into output queue {id(self.outq)}."""
+            )
+            # The put blocks while the output queue is full
+            await loop.run_in_executor(None, self.__put, epoch, wkout, dropped)
+        finally:
+            slots.release()
+
+    def __put(self, epoch: int, wkout, dropped: bool):
+        if not dropped:
+            # Written before the element is finished, so the terminal
+            # element can not overtake it in the feeder thread
+            self.safe_put(self.outq, wkout, flush=True)
+            self.count_out += 1
+        self.epoch_gate.finish(epoch, self.__put_terminal)
+
+    def __put_terminal(self, terminal: TerminateQueue):
+        self.safe_put(self.outq, terminal, flush=True)
+        logger.debug(
+            f"""\
+{self.workername} put terminal element of epoch {terminal.epoch} in outq."""
+        )
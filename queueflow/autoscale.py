@@ -0,0 +1,88 @@
+import threading
+from collections import deque
+
+from .logger import logger
+from .step_base import _all_steps
+
+
+def queue_saturation(queue) -> float:
+    """Fraction of the queue that is filled, unbounded queues
+    count as saturated as soon as they hold an element.
+    Queues with a byte budget (`ByteQueue`) are measured in bytes."""
+    max_bytes = getattr(queue, "max_bytes", None)
+    if max_bytes is not None:
+        return min(queue.nbytes / max_bytes, 1.0)
+    size = queue.qsize()
+    if queue._maxsize == 2147483647:
+        return float(size > 0)
+    return min(size / queue._maxsize, 1.0)
+
+
+class Autoscaler:
+    """Samples the saturation of the queues before and after each
+    scalable step every `interval` seconds. After `window` samples
+    a step gets an additional worker if it is the bottleneck
+    (input queue full, output queue not full) and a worker is retired
+    if the step is starved (input queue mostly empty).
+    Steps are only rescaled while data is flowing through them."""
+
+    def __init__(
+        self,
+        qfseq,
+        interval: float = 1.0,
+        window: int = 5,
+        high: float = 0.75,
+        low: float = 0.25,
+    ):
+        self.qfseq = qfseq
+        self.interval = interval
+        self.window = window
+        self.high = high
+        self.low = low
+        self.thread = threading.Thread(
+            target=self.run, daemon=True, args=(qfseq.shutdown_event,)
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def scalable_steps(self):
+        return [
+            step
+            for step in _all_steps(self.qfseq.steps)
+            if getattr(step, "min_workers", 1) < getattr(step, "max_workers", 1)
+        ]
+
+    def run(self, shutdown_event):
+        threading.current_thread().setName("autoscaler")
+        steps = self.scalable_steps()
+        samples = {id(step): deque(maxlen=self.window) for step in steps}
+        items_in = {id(step): step.metrics.snapshot()["items_in"] for step in steps}
+        while not shutdown_event.wait(self.interval):
+            for step in steps:
+                step_samples = samples[id(step)]
+                step_samples.append(
+                    (queue_saturation(step.inq), queue_saturation(step.outq))
+                )
+                if len(step_samples) < self.window:
+                    continue
+                new_items_in = step.metrics.snapshot()["items_in"]
+                flowing = new_items_in > items_in[id(step)]
+                items_in[id(step)] = new_items_in
+                in_saturation = sum(s[0] for s in step_samples) / self.window
+                out_saturation = sum(s[1] for s in step_samples) / self.window
+                step_samples.clear()
+                if not flowing:
+                    continue
+                if in_saturation >= self.high and out_saturation < self.high:
+                    delta = 1
+                elif in_saturation <= self.low:
+                    delta = -1
+                else:
+                    continue
+                logger.debug(
+                    f"""\
+Autoscaler: {step.name} input saturation {in_saturation:.2f}, \
+output saturation {out_saturation:.2f}, scaling by {delta}"""
+                )
+                step.scale(delta)
@@ -0,0 +1,331 @@
+"""Benchmarks of queueflow pipelines with synthetic workloads.
+
+    python -m queueflow.bench --output new.json
+    python -m queueflow.bench --compare old.json new.json
+
+`--queue shm` passes the elements through `ShmQueue`s instead of the
+default queues, comparing two such runs gives the effect of the queue.
+
+Each case runs one `Sequence` in a fresh process and reports the
+throughput, the latency of the elements from the first step to the
+consumer and the peak resident memory of the process and its workers.
+By default the cases vary one parameter at a time around a baseline,
+`--full` runs all combinations.
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import logging
+import platform
+import re
+import resource
+import sys
+import time
+from functools import partial
+from typing import Dict, List, NamedTuple
+
+import numpy as np
+import torch
+from prettytable import PrettyTable
+from torch import multiprocessing as mp
+
+SIZES = {"tiny": 8, "small": 2**16, "large": 2**24, "huge": 2**28}
+PAYLOADS = ("tensor", "numpy", "pyg")
+WORKS = ("cpu", "sleep")
+STEPS = ("process", "pool", "pack_unpack", "repack")
+QUEUES = ("default", "shm")
+# Work per element in seconds
+WORK_TIME = 0.001
+# Elements per chunk for the steps that take lists
+CHUNK = 8
+
+
+class Case(NamedTuple):
+    size: str = "small"
+    payload: str = "tensor"
+    work: str = "cpu"
+    step: str = "process"
+
+    @property
+    def name(self) -> str:
+        return "-".join(self)
+
+    def n_elements(self) -> int:
+        # About 1 GB per case, within 8 and 4096 elements
+        n = min(max(2**30 // SIZES[self.size], CHUNK), 4096)
+        return n - n % CHUNK
+
+
+def default_cases() -> List[Case]:
+    base = Case()
+    cases = [base]
+    for field, values in (
+        ("size", SIZES),
+        ("payload", PAYLOADS),
+        ("work", WORKS),
+        ("step", STEPS),
+    ):
+        for value in values:
+            case = base._replace(**{field: value})
+            if case not in cases:
+                cases.append(case)
+    return cases
+
+
+def full_cases() -> List[Case]:
+    combinations = itertools.product(SIZES, PAYLOADS, WORKS, STEPS)
+    return [Case(*values) for values in combinations]
+
+
+def make_payload(case: Case):
+    nbytes = SIZES[case.size]
+    if case.payload == "tensor":
+        return torch.empty(max(nbytes // 4, 1), dtype=torch.float32)
+    if case.payload == "numpy":
+        return np.empty(max(nbytes // 4, 1), dtype=np.float32)
+    from torch_geometric.data import Data
+
+    # Graph with 16 features per node and two edges per node
+    n_nodes = max(nbytes // 96, 1)
+    return Data(
+        x=torch.empty(n_nodes, 16),
+        edge_index=torch.zeros(2, 2 * n_nodes, dtype=torch.long),
+    )
+
+
+def work(case: Case, element):
+    """Create the element on the first call, then spend `WORK_TIME` on it."""
+    if not isinstance(element, dict):
+        element = {"t0": time.monotonic(), "data": make_payload(case)}
+    if case.work == "sleep":
+        time.sleep(WORK_TIME)
+    else:
+        end = time.perf_counter() + WORK_TIME
+        while time.perf_counter() < end:
+            pass
+    return element
+
+
+def work_chunk(case: Case, chunk):
+    return [work(case, element) for element in chunk]
+
+
+def build_steps(case: Case, nworkers: int):
+    import queueflow as qf
+
+    fn = partial(work, case)
+    if case.step == "process":
+        steps = [qf.ProcessStep(fn, nworkers, name="work")]
+    elif case.step == "pool":
+        steps = [qf.PoolStep(fn, nworkers=nworkers, name="work"), qf.UnpackStep()]
+    elif case.step == "pack_unpack":
+        steps = [
+            qf.ProcessStep(fn, nworkers, name="work"),
+            qf.PackStep(mp.Value("i", CHUNK)),
+            qf.UnpackStep(),
+        ]
+    elif case.step == "repack":
+        steps = [
+            qf.ProcessStep(partial(work_chunk, case), nworkers, name="work"),
+            qf.RepackStep(mp.Value("i", CHUNK * 2)),
+        ]
+    else:
+        raise ValueError(f"Unknown step {case.step}, expected one of {STEPS}")
+    # Lists of elements go into the steps that map over chunks
+    chunked = case.step in ("pool", "repack")
+    return steps, chunked
+
+
+def run_case(case: Case, nworkers: int, queue: str = "default") -> Dict:
+    """Run the case in this process, which has to be a fresh process."""
+    import queueflow as qf
+
+    # The global shutdown event may be inherited from the parent process,
+    # give the steps of this case their own.
+    qf.shutdown_event = qf.ShutdownEvent()
+    logging.getLogger("queueflow").setLevel(logging.ERROR)
+    n = case.n_elements()
+    steps, chunked = build_steps(case, nworkers)
+    seq = qf.Sequence(*steps, queue_type=qf.ShmQueue if queue == "shm" else None)
+    seq.start()
+    if chunked:
+        iterable = [list(range(i, i + CHUNK)) for i in range(0, n, CHUNK)]
+    else:
+        iterable = range(n)
+    latencies = []
+    start = time.monotonic()
+    seq.queue_iterable(iterable)
+    for out in seq:
+        now = time.monotonic()
+        for element in out if isinstance(out, list) else [out]:
+            latencies.append(now - element["t0"])
+    elapsed = time.monotonic() - start
+    with contextlib.redirect_stdout(io.StringIO()):
+        seq.stop()
+    # ru_maxrss is given in KiB on Linux
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    assert len(latencies) == n, f"Expected {n} outputs, got {len(latencies)}."
+    return {
+        "elements": n,
+        "seconds": elapsed,
+        "elements_per_s": n / elapsed,
+        "mb_per_s": n * SIZES[case.size] / elapsed / 2**20,
+        "latency_p50_ms": float(np.percentile(latencies, 50)) * 1000,
+        "latency_p99_ms": float(np.percentile(latencies, 99)) * 1000,
+        "peak_rss_mb": peak_rss / 1024,
+    }
+
+
+def _run_case_child(case: Case, nworkers: int, queue: str, conn):
+    try:
+        conn.send(("ok", run_case(case, nworkers, queue)))
+    except Exception as error:
+        conn.send(("error", f"{type(error).__name__}: {error}"))
+
+
+def run(
+    cases: List[Case], nworkers: int, queue: str = "default", timeout: float = 600
+) -> Dict:
+    ctx = mp.get_context("fork")
+    results = []
+    for case in cases:
+        result = {"name": case.name, **case._asdict()}
+        if case.payload == "pyg" and not _has_torch_geometric():
+            results.append({**result, "status": "skipped: torch_geometric missing"})
+            continue
+        reader, writer = ctx.Pipe(duplex=False)
+        process = ctx.Process(
+            target=_run_case_child, args=(case, nworkers, queue, writer)
+        )
+        process.start()
+        writer.close()
+        if reader.poll(timeout):
+            status, values = reader.recv()
+        else:
+            status, values = "error", f"timeout after {timeout}s"
+        process.join(10)
+        if process.is_alive():
+            process.kill()
+        if status == "ok":
+            results.append({**result, "status": "ok", **values})
+        else:
+            results.append({**result, "status": f"error: {values}"})
+        print(_format_result(results[-1]), file=sys.stderr)
+    return {
+        "environment": environment(),
+        "nworkers": nworkers,
+        "queue": queue,
+        "cases": results,
+    }
+
+
+def _has_torch_geometric() -> bool:
+    try:
+        import torch_geometric  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _format_result(result: Dict) -> str:
+    if result["status"] != "ok":
+        return f"{result['name']}: {result['status']}"
+    return (
+        f"{result['name']}: {result['elements_per_s']:.1f} elements/s,"
+        f" p50 {result['latency_p50_ms']:.2f} ms,"
+        f" p99 {result['latency_p99_ms']:.2f} ms,"
+        f" peak rss {result['peak_rss_mb']:.0f} MB"
+    )
+
+
+def environment() -> Dict:
+    try:
+        from importlib.metadata import version
+
+        queueflow_version = version("queueflow")
+    except Exception:
+        queueflow_version = "unknown"
+    return {
+        "queueflow": queueflow_version,
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": mp.cpu_count(),
+    }
+
+
+COMPARED = ("elements_per_s", "latency_p50_ms", "latency_p99_ms", "peak_rss_mb")
+
+
+def compare(base: Dict, new: Dict) -> PrettyTable:
+    """Table of the ratios new / base of the cases present in both results."""
+    base_cases = {c["name"]: c for c in base["cases"] if c["status"] == "ok"}
+    table = PrettyTable(["case", *COMPARED])
+    for case in new["cases"]:
+        old = base_cases.get(case["name"])
+        if case["status"] != "ok" or old is None:
+            continue
+        table.add_row(
+            [
+                case["name"],
+                *(
+                    f"{case[field]:.4g} ({case[field] / old[field]:.2f}x)"
+                    if old[field]
+                    else f"{case[field]:.4g}"
+                    for field in COMPARED
+                ),
+            ]
+        )
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark queueflow pipelines with synthetic workloads."
+    )
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--filter", help="only run cases whose name matches the regex")
+    parser.add_argument("--full", action="store_true", help="run all combinations")
+    parser.add_argument("--nworkers", type=int, default=4)
+    parser.add_argument(
+        "--queue", choices=QUEUES, default="default", help="queues between the steps"
+    )
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BASE", "NEW"),
+        help="compare two result files instead of running the cases",
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            base = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        print(compare(base, new))
+        return
+
+    cases = full_cases() if args.full else default_cases()
+    if args.filter:
+        cases = [case for case in cases if re.search(args.filter, case.name)]
+    results = run(cases, args.nworkers, args.queue)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    # Run the functions of the imported module, so the functions
+    # given to the steps do not refer to `__main__`.
+    from queueflow.bench import main
+
+    main()
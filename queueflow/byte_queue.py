@@ -0,0 +1,167 @@
+import time
+from functools import partial
+from multiprocessing.queues import Full
+from multiprocessing.queues import Queue as queues_class
+
+from torch import multiprocessing as mp
+
+from .handlers import size
+from .ordering import write_flushed
+from .terminate_queue import TerminateQueue
+
+
+class _ReservingQueue(queues_class):
+    """Queue whose elements reserve units of a capacity given by the
+    subclass before they are sent and release them when they are
+    received, see `ByteQueue`."""
+
+    def __init__(self, maxsize: int = 0):
+        super().__init__(maxsize, ctx=mp.get_context())
+        self._reserved = mp.Value("q", 0, lock=False)
+        self._reserved_cond = mp.Condition()
+
+    def __getstate__(self):
+        return super().__getstate__(), self._reserved, self._reserved_cond
+
+    def __setstate__(self, state):
+        base_state, self._reserved, self._reserved_cond = state
+        super().__setstate__(base_state)
+
+    def _units(self, obj) -> int:
+        raise NotImplementedError
+
+    def _capacity(self) -> int:
+        raise NotImplementedError
+
+    def put(self, obj, block=True, timeout=None):
+        self.__put(obj, block, timeout, super().put)
+
+    def put_flushed(self, obj, block=True, timeout=None):
+        """See `ordering.put_flushed`."""
+        self.__put(obj, block, timeout, partial(write_flushed, self))
+
+    def __put(self, obj, block, timeout, put):
+        if self._closed:
+            raise ValueError(f"Queue {self!r} is closed")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        units = self._units(obj)
+        if isinstance(obj, TerminateQueue):
+            limit, put = lambda: 0, partial(write_flushed, self)
+        else:
+            limit = self._capacity
+        with self._reserved_cond:
+            fits = self._reserved_cond.wait_for(
+                lambda: self._reserved.value == 0
+                or self._reserved.value + units <= limit(),
+                timeout if block else 0,
+            )
+            if not fits:
+                raise Full
+            self._reserved.value += units
+        try:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+            # The units travel with the element, so the consumer
+            # releases exactly the units that were reserved
+            put((units, obj), block, remaining)
+        except BaseException:
+            self._release(units)
+            raise
+
+    def get(self, block=True, timeout=None):
+        units, obj = super().get(block, timeout)
+        self._release(units)
+        return obj
+
+    def _release(self, units: int):
+        with self._reserved_cond:
+            self._reserved.value -= units
+            self._reserved_cond.notify_all()
+
+
+class ByteQueue(_ReservingQueue):
+    """Queue whose capacity is given in bytes instead of elements.
+    The size of the elements is estimated by the handlers of their type
+    (see `queueflow.register_handler`). A `put` blocks while the elements
+    in the queue and the new element exceed `max_bytes`, but an element
+    is always accepted by an empty queue, so larger elements pass one
+    by one. `maxsize` additionally limits the number of elements.
+
+    The terminal element waits until the queue is empty and is written
+    before `put` returns: elements put by the feeder threads of other
+    workers could overtake it or be overtaken by it otherwise.
+
+    Can be placed in a `Sequence` like a `Queue`, or created by the
+    `Sequence` from its `memory_budget`."""
+
+    def __init__(self, max_bytes: int, maxsize: int = 0):
+        super().__init__(maxsize)
+        if max_bytes < 1:
+            raise ValueError("ByteQueue needs a positive max_bytes.")
+        self.max_bytes = max_bytes
+
+    def __getstate__(self):
+        return super().__getstate__(), self.max_bytes
+
+    def __setstate__(self, state):
+        base_state, self.max_bytes = state
+        super().__setstate__(base_state)
+
+    @property
+    def nbytes(self) -> int:
+        """Estimated bytes of the elements in the queue."""
+        return self._reserved.value
+
+    def _units(self, obj) -> int:
+        return size(obj)
+
+    def _capacity(self) -> int:
+        return self.max_bytes
+
+
+class ResizableQueue(_ReservingQueue):
+    """Queue of at most `maxsize` elements, `resize` changes the maximal
+    size while the processes of a `Sequence` use the queue. Inserted
+    between the steps by `Sequence(..., tune_queues=True)`, see
+    `QueueTuner`. Like the `ByteQueue` the terminal element waits until
+    the queue is empty."""
+
+    def __init__(self, maxsize: int = 1):
+        if maxsize < 1:
+            raise ValueError("ResizableQueue needs a positive maxsize.")
+        self._limit = mp.Value("i", maxsize, lock=False)
+        super().__init__()
+
+    def __getstate__(self):
+        return super().__getstate__(), self._limit
+
+    def __setstate__(self, state):
+        base_state, self._limit = state
+        super().__setstate__(base_state)
+
+    @property
+    def _maxsize(self) -> int:
+        return self._limit.value
+
+    @_maxsize.setter
+    def _maxsize(self, value):
+        # The base class stores the size of its semaphore,
+        # which is unbounded here
+        pass
+
+    def resize(self, maxsize: int):
+        if maxsize < 1:
+            raise ValueError("ResizableQueue needs a positive maxsize.")
+        with self._reserved_cond:
+            self._limit.value = maxsize
+            self._reserved_cond.notify_all()
+
+    def qsize(self) -> int:
+        return self._reserved.value
+
+    def _units(self, obj) -> int:
+        return 1
+
+    def _capacity(self) -> int:
+        return self._limit.value
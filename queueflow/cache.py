@@ -0,0 +1,167 @@
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import threading
+from pathlib import Path
+
+from . import pickling
+from .logger import logger
+
+# Alignment of the buffers in the files, so tensors and arrays
+# mapped from the files are aligned for any dtype
+ALIGN = 64
+
+
+class DiskCache:
+    """Content addressed store of the outputs of a worker function,
+    shared by the processes and the runs that use the same `path`.
+    Pass it to a step with `cache=DiskCache(path, version="v1")`,
+    inputs seen before are then not processed again.
+
+    The key of an element is the hash of `version`, of the pickled worker
+    function (with the arguments of a `functools.partial`) and of the
+    pickled element, change `version` when the worker function changes.
+    The outputs are stored in one file each: a header with the pickle
+    stream followed by the raw data of the tensors and arrays, which are
+    mapped back into memory instead of being read and unpickled,
+    tensors are restored on the CPU.
+    Once the files exceed `max_bytes`, the least recently used files
+    are deleted. Files that can not be read are deleted and count as
+    misses."""
+
+    def __init__(self, path, version: str = "", max_bytes: int = 2**34):
+        self.path = Path(path)
+        self.version = version
+        self.max_bytes = max_bytes
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Bytes written by this process since the size was checked
+        self.__written = max_bytes
+
+    def key(self, element, namespace: str = "") -> str:
+        """Hash of the element, `namespace` separates the outputs
+        of different functions stored in the same path."""
+        stream, buffers = pickling.dumps(element)
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f"{namespace}\0{self.version}\0".encode())
+        digest.update(stream)
+        for buffer in buffers:
+            digest.update(buffer)
+        return digest.hexdigest()
+
+    @staticmethod
+    def namespace(fn) -> str:
+        """Namespace of the outputs of the worker function `fn`, the hash
+        of its pickle. Functions are pickled by reference, the arguments
+        of a `functools.partial` by value."""
+        try:
+            stream = pickle.dumps(fn)
+        except Exception as error:
+            raise TypeError(
+                f"The worker function {fn!r} of a cached step must be picklable "
+                f"(no lambda or local function), its pickle separates the outputs "
+                f"of different functions: {error}"
+            ) from None
+        return hashlib.blake2b(stream, digest_size=20).hexdigest()
+
+    def __file(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}.qfc"
+
+    def __contains__(self, key: str) -> bool:
+        return self.__file(key).exists()
+
+    def __getitem__(self, key: str):
+        path = self.__file(key)
+        try:
+            with open(path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            value = self.__load(mapped)
+        except FileNotFoundError:
+            raise KeyError(key) from None
+        # Empty or truncated files, eg. after the disk ran full
+        except Exception as error:
+            logger.warning(f"Deleting unreadable file {path} of the cache: {error!r}")
+            _unlink(path)
+            raise KeyError(key) from None
+        # The modification time orders the files for the eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    @staticmethod
+    def __load(mapped):
+        (header_size,) = struct.unpack_from("<Q", mapped)
+        sizes, stream = pickle.loads(mapped[8 : 8 + header_size])
+        view = memoryview(mapped)
+        buffers = []
+        offset = 8 + header_size
+        for size in sizes:
+            offset += -offset % ALIGN
+            if offset + size > len(mapped):
+                raise ValueError("file is truncated")
+            buffers.append(view[offset : offset + size])
+            offset += size
+        return pickling.loads(stream, buffers)
+
+    def __setitem__(self, key: str, value):
+        stream, buffers = pickling.dumps(value)
+        header = pickle.dumps(([buffer.nbytes for buffer in buffers], stream))
+        path = self.__file(key)
+        path.parent.mkdir(exist_ok=True)
+        # Write to a temporary file, so readers never see a partial file
+        tmp_path = path.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(struct.pack("<Q", len(header)))
+                f.write(header)
+                for buffer in buffers:
+                    f.write(b"\0" * (-f.tell() % ALIGN))
+                    f.write(buffer)
+                size = f.tell()
+            os.replace(tmp_path, path)
+        # `evict` only sees the complete files
+        except BaseException:
+            _unlink(tmp_path)
+            raise
+        self.__written += size
+        if self.__written >= self.max_bytes // 16:
+            self.evict()
+
+    def store(self, key: str, value) -> bool:
+        """Like `cache[key] = value`, but outputs that can not be stored
+        are only logged. Returns True if the output was stored."""
+        try:
+            self[key] = value
+            return True
+        except Exception as error:
+            logger.warning(f"Could not store output in cache {self.path}: {error}")
+            return False
+
+    def evict(self):
+        """Delete the least recently used files until the cache
+        holds at most `max_bytes`."""
+        self.__written = 0
+        files = []
+        for path in self.path.glob("*/*.qfc"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            _unlink(path)
+            total -= size
+        logger.debug(f"Cache {self.path} holds {total} bytes after eviction.")
+
+
+def _unlink(path: Path):
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,75 @@
+from numbers import Number
+from typing import List
+
+import numpy as np
+import torch
+
+
+def default_collate(elements: List):
+    """Collate a list of elements into a single batch, that can be passed
+    to `PackStep` and `RepackStep` as `collate_fn`:
+
+    - Tensors of equal shape are stacked into one tensor, which is allocated
+      in shared memory, so the queue does not copy it once more.
+    - Numpy arrays of equal shape are stacked into one array.
+    - Numbers are converted to a tensor.
+    - Dicts, tuples and lists are collated field by field, they must have
+      the same keys and lengths.
+    - torch_geometric `Data` objects are collated into a `Batch`.
+
+    Other elements are returned as a list."""
+    first = elements[0]
+    if isinstance(first, torch.Tensor):
+        return collate_tensors(elements)
+    if isinstance(first, np.ndarray):
+        return collate_arrays(elements)
+    if isinstance(first, Number):
+        return torch.tensor(elements)
+    if isinstance(first, dict):
+        keys = set(first)
+        for element in elements:
+            if set(element) != keys:
+                raise ValueError(
+                    f"Can not collate dicts with differing keys: {sorted(keys, key=str)} \
+and {sorted(element, key=str)}."
+                )
+        return {key: default_collate([e[key] for e in elements]) for key in first}
+    if isinstance(first, (tuple, list)):
+        lengths = {len(element) for element in elements}
+        if len(lengths) > 1:
+            raise ValueError(
+                f"Can not collate {type(first).__name__}s of differing lengths: \
+{sorted(lengths)}, each element of the batch should be of equal size."
+            )
+        fields = [default_collate(list(field)) for field in zip(*elements)]
+        if hasattr(first, "_fields"):
+            return type(first)(*fields)
+        return type(first)(fields)
+    if _is_pyg_data(first):
+        from torch_geometric.data import Batch
+
+        return Batch.from_data_list(elements)
+    return list(elements)
+
+
+def collate_tensors(tensors: List[torch.Tensor]) -> torch.Tensor:
+    first = tensors[0]
+    out = torch.empty(
+        (len(tensors), *first.shape), dtype=first.dtype, device=first.device
+    )
+    if out.device.type == "cpu":
+        out.share_memory_()
+    return torch.stack(tensors, out=out)
+
+
+def collate_arrays(arrays: List[np.ndarray]) -> np.ndarray:
+    first = arrays[0]
+    out = np.empty((len(arrays), *first.shape), dtype=first.dtype)
+    return np.stack(arrays, out=out)
+
+
+def _is_pyg_data(element) -> bool:
+    # Checked by name, so torch_geometric is only imported
+    # once the first graph is collated.
+    names = {f"{base.__module__}.{base.__qualname__}" for base in type(element).__mro__}
+    return "torch_geometric.data.data.BaseData" in names
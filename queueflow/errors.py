@@ -0,0 +1,56 @@
+import traceback
+from typing import NamedTuple
+
+# "raise": the error is reported and the `Sequence` shuts down.
+# "skip": the element is dropped with a warning.
+# "deadletter": the element is dropped and collected in
+#   `Sequence.dead_letters` together with the error.
+ERROR_POLICIES = ("raise", "skip", "deadletter")
+
+
+class DeadLetter(NamedTuple):
+    """Element a step failed on, with `on_error="deadletter"`.
+    The element is converted by the `serialize` handler of its type."""
+
+    step: str
+    element: object
+    error: str
+    traceback: str
+
+
+class Failed(NamedTuple):
+    """Result of a call in a process of a pool that failed."""
+
+    error: str
+    traceback: str
+
+
+def call_with_retries(fn, retries: int, element):
+    """Call `fn` on the element, calling it again up to `retries` times
+    if it raises. The error of the last call is raised."""
+    for _ in range(retries):
+        try:
+            return fn(element)
+        except Exception:
+            continue
+    return fn(element)
+
+
+async def call_with_retries_async(fn, retries: int, element):
+    """`call_with_retries` for an `async def` function."""
+    for _ in range(retries):
+        try:
+            return await fn(element)
+        except Exception:
+            continue
+    return await fn(element)
+
+
+def pool_call(fn, retries: int, element):
+    """`call_with_retries` in a process of a pool, a failure is returned
+    as `Failed`, so the step handles the element by its policy and the
+    other elements of the chunk are kept."""
+    try:
+        return call_with_retries(fn, retries, element)
+    except Exception as error:
+        return Failed(repr(error), traceback.format_exc())
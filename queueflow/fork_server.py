@@ -0,0 +1,120 @@
+import atexit
+import os
+import signal
+import threading
+import time
+
+from torch import multiprocessing as mp
+
+from .logger import logger
+
+
+class ForkServer:
+    """Process that forks the workers started while the `Sequence` runs
+    (replacements by `respawn`, additional workers by `scale`).
+
+    Forking a process with running threads can deadlock the new process,
+    eg. if another thread holds the lock of the logger at the time of the
+    fork. The fork server is forked by the `Sequence` before it starts
+    its threads and stays single-threaded, so the workers forked by it
+    are safe. It holds a copy of the steps from that time, the workers
+    share the queues and the shared state of the steps as usual.
+
+    The workers are children of the fork server, `ForkedProcess` stands
+    in for them in the `processes` of their step."""
+
+    def __init__(self, steps):
+        self.steps = list(steps)
+        self._conn, self._server_conn = mp.Pipe()
+        # Requests from the threads of the `Sequence` are sent one by one
+        self._lock = threading.Lock()
+        # Not daemonic, daemonic processes can not have children
+        self.process = mp.Process(target=self._serve, daemon=False, name="forkServer")
+
+    def start(self):
+        self.process.start()
+        # Stopped before `multiprocessing` joins its children at exit
+        atexit.register(self.stop)
+
+    def stop(self):
+        with self._lock:
+            if not self.process.is_alive():
+                return
+            self._conn.send(None)
+        self.process.join(5)
+        if self.process.exitcode is None:
+            self.process.kill()
+        atexit.unregister(self.stop)
+
+    def start_worker(self, step) -> "ForkedProcess":
+        """Fork a new worker of `step`."""
+        pid, name = self.__request("start", self.steps.index(step))
+        return ForkedProcess(self, pid, name)
+
+    def exitcode(self, pid: int):
+        return self.__request("exitcode", pid)
+
+    def __request(self, *request):
+        with self._lock:
+            self._conn.send(request)
+            return self._conn.recv()
+
+    def _serve(self):
+        processes = {}
+        while True:
+            try:
+                request = self._server_conn.recv()
+            except EOFError:
+                break
+            # The `Sequence` handles the interrupt and stops the fork server
+            except KeyboardInterrupt:
+                continue
+            if request is None:
+                break
+            command, arg = request
+            if command == "start":
+                process = self.steps[arg]._new_process()
+                process.start()
+                processes[process.pid] = process
+                self._server_conn.send((process.pid, process.name))
+            elif command == "exitcode":
+                self._server_conn.send(processes[arg].exitcode)
+        # The daemonic workers are terminated when the fork server exits
+        logger.debug(f"Fork server exiting with {len(processes)} workers.")
+
+
+class ForkedProcess:
+    """Stands in for a worker forked by the `ForkServer`, with the parts of
+    the `multiprocessing.Process` interface used by the steps."""
+
+    def __init__(self, fork_server: ForkServer, pid: int, name: str):
+        self.fork_server = fork_server
+        self.pid = pid
+        self.name = name
+        self._exitcode = None
+
+    @property
+    def exitcode(self):
+        if self._exitcode is None:
+            try:
+                self._exitcode = self.fork_server.exitcode(self.pid)
+            except (EOFError, OSError):
+                # The fork server exited and terminated its workers
+                self._exitcode = -signal.SIGTERM
+        return self._exitcode
+
+    def is_alive(self) -> bool:
+        return self.exitcode is None
+
+    def join(self, timeout: float = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.exitcode is None:
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+            time.sleep(0.01)
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
@@ -0,0 +1,151 @@
+import sys
+from types import GeneratorType
+from typing import Callable, Dict, NamedTuple, Union
+
+import numpy as np
+import torch
+
+
+class DataHandler(NamedTuple):
+    """Functions to handle the elements of one type:
+    `clone` detaches the element from memory shared with other processes,
+    `move` moves it to a torch device,
+    `serialize` converts it to plain python and numpy objects for error reports
+    and `size` estimates the number of bytes it occupies."""
+
+    clone: Callable
+    move: Callable
+    serialize: Callable
+    size: Callable
+
+
+# Handlers by type or by the qualified name of the type
+# (eg. "torch_geometric.data.data.Data"), so modules that
+# are not imported yet do not need to be imported to register them.
+_registry: Dict[Union[type, str], DataHandler] = {}
+# Resolved handlers by the exact type of the element
+_cache: Dict[type, DataHandler] = {}
+
+
+def register_handler(
+    key: Union[type, str],
+    clone: Callable = None,
+    move: Callable = None,
+    serialize: Callable = None,
+    size: Callable = None,
+):
+    """Register the handler functions for the type `key` and its subclasses.
+    Functions that are not given are taken from the fallback handler."""
+    _registry[key] = DataHandler(
+        clone=clone or _default.clone,
+        move=move or _default.move,
+        serialize=serialize or _default.serialize,
+        size=size or _default.size,
+    )
+    _cache.clear()
+
+
+def get_handler(element) -> DataHandler:
+    cls = type(element)
+    handler = _cache.get(cls)
+    if handler is None:
+        handler = _cache[cls] = _resolve(cls)
+    return handler
+
+
+def _resolve(cls: type) -> DataHandler:
+    for base in cls.__mro__:
+        if base in _registry:
+            return _registry[base]
+        name = f"{base.__module__}.{base.__qualname__}"
+        if name in _registry:
+            return _registry[name]
+    return _default
+
+
+def clone(element):
+    return get_handler(element).clone(element)
+
+
+def move(element, device):
+    return get_handler(element).move(element, device)
+
+
+def serialize(element):
+    return get_handler(element).serialize(element)
+
+
+def size(element) -> int:
+    return get_handler(element).size(element)
+
+
+def _identity(element, *args):
+    return element
+
+
+def _rebuild(container, values):
+    # Named tuples take the fields as positional arguments
+    if hasattr(container, "_fields"):
+        return type(container)(*values)
+    return type(container)(values)
+
+
+def _move_generic(element, device):
+    if hasattr(element, "to") and callable(getattr(element, "to")):
+        return element.to(device)
+    raise RuntimeError("Cannot move this object to the torch device, invalid type.")
+
+
+_default = DataHandler(
+    clone=_identity,
+    move=_move_generic,
+    serialize=_identity,
+    size=sys.getsizeof,
+)
+
+
+def _serialize_pyg(batch):
+    # Imports torch_geometric, but only once a graph has been seen
+    from .batch_utils import batch_to_numpy_dict
+
+    return batch_to_numpy_dict(batch)
+
+
+def _size_pyg(batch) -> int:
+    return sum(size(v) for v in batch.to_dict().values())
+
+
+register_handler(
+    torch.Tensor,
+    clone=torch.Tensor.clone,
+    move=torch.Tensor.to,
+    serialize=lambda t: t.detach().cpu().numpy(),
+    size=lambda t: t.element_size() * t.nelement(),
+)
+register_handler(np.ndarray, move=_identity, size=lambda a: a.nbytes)
+register_handler(np.generic, move=_identity, size=lambda a: a.nbytes)
+for _type in (int, float, bool, str, bytes, type(None)):
+    register_handler(_type, move=_identity)
+for _type in (list, tuple, set):
+    register_handler(
+        _type,
+        clone=lambda e: _rebuild(e, (clone(v) for v in e)),
+        move=lambda e, device: _rebuild(e, (move(v, device) for v in e)),
+        serialize=lambda e: _rebuild(e, (serialize(v) for v in e)),
+        size=lambda e: sys.getsizeof(e) + sum(size(v) for v in e),
+    )
+register_handler(
+    dict,
+    clone=lambda e: {k: clone(v) for k, v in e.items()},
+    move=lambda e, device: {k: move(v, device) for k, v in e.items()},
+    serialize=lambda e: {k: serialize(v) for k, v in e.items()},
+    size=lambda e: sys.getsizeof(e) + sum(size(v) for v in e.values()),
+)
+register_handler(GeneratorType, clone=lambda e: (clone(v) for v in e))
+register_handler(
+    "torch_geometric.data.data.BaseData",
+    clone=lambda batch: batch.clone(),
+    move=lambda batch, device: batch.to(device),
+    serialize=_serialize_pyg,
+    size=_size_pyg,
+)
@@ -1,9 +1,9 @@
+from itertools import islice
 from multiprocessing.queues import Empty, Full
 
-import torch_geometric
-
 from .handle_data import HandleDataBase
 from .logger import logger
+from .shutdown_event import get_or_shutdown, wait_readable
 from .terminate_queue import TerminateQueue
 
 
@@ -26,15 +26,23 @@ class InputStep(InOutStep):
     def __init__(self, shutdown_event):
         self.name = "input step"
         self.shutdown_event = shutdown_event
-
-    def queue_iterable(self, iterable_object):
+        # Number of elements put over all iterables and for each epoch
+        # the elements put before it and the number of skipped elements
+        self.n_put = 0
+        self.epochs = {}
+
+    def queue_iterable(self, iterable_object, epoch: int = None, start: int = 0):
+        """Put the elements of the iterable and the terminal element,
+        the first `start` elements are skipped."""
         assert hasattr(iterable_object, "__iter__")
+        self.epochs[epoch] = (self.n_put, start)
         i = 0
-        for element in iterable_object:
+        for element in islice(iterable_object, start, None):
             self.safe_put(self.outq, element)
             i = i + 1
-        logger.debug(f"Queuing {i} elements complete")
-        self.safe_put(self.outq, TerminateQueue())
+            self.n_put += 1
+        logger.debug(f"Queuing {i} elements of epoch {epoch} complete")
+        self.safe_put(self.outq, TerminateQueue(epoch))
 
     def connect_to_sequence(self, output_queue):
         self.outq = output_queue
@@ -46,6 +54,10 @@ class OutputStep(InOutStep):
     def __init__(self, shutdown_event):
         self.name = "output step"
         self.shutdown_event = shutdown_event
+        # Epoch of the last terminal element
+        self.epoch = None
+        # Number of outputs returned over all iterables
+        self.count_out = 0
 
     def start(self):
         pass
@@ -56,15 +68,38 @@ class OutputStep(InOutStep):
     def __next__(self):
         while not self.shutdown_event.is_set():
             try:
-                out = self.inq.get(block=True, timeout=0.05)
+                out = get_or_shutdown(self.inq, self.shutdown_event)
                 if isinstance(out, TerminateQueue):
-                    logger.debug("OutputStep got terminal element.")
+                    logger.debug(
+                        f"OutputStep got terminal element of epoch {out.epoch}."
+                    )
+                    self.epoch = out.epoch
                     break
-                return self._clone_tensors(out)
+                self.count_out += 1
+                return self._take_ownership(out)
             except Empty:
                 continue
             logger.debug("Sequence output ready.")
         raise StopIteration
 
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Like `__next__`, but waits for the output in the running event loop."""
+        while not self.shutdown_event.is_set():
+            try:
+                out = self.inq.get(block=False)
+            except Empty:
+                await wait_readable(self.inq, self.shutdown_event, timeout=1)
+                continue
+            if isinstance(out, TerminateQueue):
+                logger.debug(f"OutputStep got terminal element of epoch {out.epoch}.")
+                self.epoch = out.epoch
+                break
+            self.count_out += 1
+            return self._take_ownership(out)
+        raise StopAsyncIteration
+
     def connect_to_sequence(self, input_queue):
         self.inq = input_queue
@@ -0,0 +1,138 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from torch import multiprocessing as mp
+
+from .logger import logger
+
+
+class StepMetrics:
+    """Counters of a step, shared by all worker processes of the step.
+    Times are summed over the workers and given in seconds."""
+
+    fields = (
+        "items_in",
+        "items_out",
+        "work_time",
+        "get_blocked_time",
+        "put_blocked_time",
+        "cache_hits",
+        "cache_misses",
+        "errors",
+        "respawns",
+    )
+    # The fields only grow, they are exported as Prometheus counters
+    counters = fields
+
+    def __init__(self):
+        self._values = mp.Array("d", len(self.fields))
+        self._index = {field: i for i, field in enumerate(self.fields)}
+        self._start_time = mp.Value("d", time.time())
+
+    def reset_clock(self):
+        self._start_time.value = time.time()
+
+    def add(self, **increments):
+        with self._values.get_lock():
+            for field, value in increments.items():
+                self._values[self._index[field]] += value
+
+    def snapshot(self, nprocesses: int = 1):
+        with self._values.get_lock():
+            values = dict(zip(self.fields, self._values[:]))
+        elapsed = max(time.time() - self._start_time.value, 1e-9)
+        busy_time = elapsed * max(nprocesses, 1)
+        values["items_in"] = int(values["items_in"])
+        values["items_out"] = int(values["items_out"])
+        values["cache_hits"] = int(values["cache_hits"])
+        values["cache_misses"] = int(values["cache_misses"])
+        values["errors"] = int(values["errors"])
+        values["respawns"] = int(values["respawns"])
+        values["elapsed"] = elapsed
+        values["items_in_per_s"] = values["items_in"] / elapsed
+        values["items_out_per_s"] = values["items_out"] / elapsed
+        values["work_time_per_item"] = (
+            values["work_time"] / values["items_in"] if values["items_in"] else 0.0
+        )
+        # Fraction of the time the workers waited for input (starved)
+        # or for space in the output queue (backpressured)
+        values["get_blocked_fraction"] = values["get_blocked_time"] / busy_time
+        values["put_blocked_fraction"] = values["put_blocked_time"] / busy_time
+        return values
+
+
+def _label_value(value) -> str:
+    """Escape a label value for the Prometheus text format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_prometheus(metrics: dict) -> str:
+    """Format the output of `Sequence.metrics` in the Prometheus text format.
+    The counters of `StepMetrics` are exported with the suffix `_total`."""
+    lines = []
+    step_fields = []
+    if metrics["steps"]:
+        step_fields = [k for k in metrics["steps"][0] if k != "name"]
+    for field in step_fields:
+        if field in StepMetrics.counters:
+            name, metric_type = f"queueflow_step_{field}_total", "counter"
+        else:
+            name, metric_type = f"queueflow_step_{field}", "gauge"
+        lines.append(f"# TYPE {name} {metric_type}")
+        for istep, step in enumerate(metrics["steps"]):
+            lines.append(
+                f'{name}{{step="{_label_value(step["name"])}",index="{istep}"}}'
+                f" {step[field]}"
+            )
+    for field in ("size", "maxsize"):
+        lines.append(f"# TYPE queueflow_queue_{field} gauge")
+        for iqueue, queue in enumerate(metrics["queues"]):
+            value = queue[field] if queue[field] != "inf" else "+Inf"
+            lines.append(f'queueflow_queue_{field}{{index="{iqueue}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """Serves the metrics of a sequence under `/metrics` (Prometheus text)
+    and `/metrics.json` from a daemon thread."""
+
+    daemon_threads = True
+
+    def __init__(self, qfseq, host: str = "127.0.0.1", port: int = 9100):
+        super().__init__((host, port), _MetricsHandler)
+        self.qfseq = qfseq
+        self.thread = threading.Thread(
+            target=self.serve_forever, daemon=True, name="metricsServer"
+        )
+
+    def start(self):
+        self.thread.start()
+        logger.info(f"Serving queueflow metrics on port {self.server_address[1]}")
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = format_prometheus(self.server.qfseq.metrics())
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body = json.dumps(self.server.qfseq.metrics())
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        body = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics server: " + format % args)
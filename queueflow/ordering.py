@@ -0,0 +1,240 @@
+from multiprocessing.queues import Empty, Full
+from multiprocessing.reduction import ForkingPickler
+
+from torch import multiprocessing as mp
+
+from .terminate_queue import TerminateQueue
+
+
+class Turnstile:
+    """Keeps the outputs of the workers of a step in the order of the inputs.
+
+    A worker draws a ticket together with the element it takes from the input
+    queue and may only put its output once all outputs with lower tickets
+    have been put. A finished worker waits for its turn before it takes
+    the next element, so the reorder buffer is bounded by the number
+    of workers (one parked output per worker).
+
+    Tickets must be drawn under the same lock as the element is taken
+    from the queue, otherwise the tickets do not match the input order."""
+
+    def __init__(self):
+        self._next_ticket = mp.Value("q", 0, lock=False)
+        self._cond = mp.Condition()
+        self._turn = mp.Value("q", 0, lock=False)
+
+    def draw(self) -> int:
+        ticket = self._next_ticket.value
+        self._next_ticket.value += 1
+        return ticket
+
+    def wait_turn(self, ticket: int, shutdown_event) -> bool:
+        """Block until it is the turn of `ticket`,
+        returns False if the shutdown event is set before."""
+        with self._cond:
+            while not self._cond.wait_for(
+                lambda: self._turn.value == ticket, timeout=1
+            ):
+                if shutdown_event.is_set():
+                    return False
+        return True
+
+    def next_turn(self):
+        with self._cond:
+            self._turn.value += 1
+            self._cond.notify_all()
+
+    def pass_turn(self, ticket: int, shutdown_event) -> bool:
+        """Pass the turn of `ticket` without an output, unless it has been
+        passed already. Returns False if the shutdown event is set before."""
+        with self._cond:
+            while not self._cond.wait_for(
+                lambda: self._turn.value >= ticket, timeout=1
+            ):
+                if shutdown_event.is_set():
+                    return False
+            if self._turn.value == ticket:
+                self._turn.value += 1
+                self._cond.notify_all()
+        return True
+
+
+class EpochGate:
+    """Passes on the terminal elements of a step with multiple workers.
+
+    The workers count the elements of each epoch that they take from the
+    input queue and the elements that they finished. The terminal element
+    is put by the worker that finishes the last element of its epoch, or
+    by the worker that takes it if the elements are finished already, so
+    the end of an epoch costs no further queue operations. Outputs wait
+    until the terminal elements of the previous epochs have been put:
+    workers that are done with an epoch continue with the next one
+    instead of waiting for the other workers.
+
+    The terminal elements are put without holding the lock of the gate, as
+    the put blocks while the output queue is full. Meanwhile one worker is
+    the putter, the other workers only count their elements. If the putter
+    crashes, `release` of its slot hands the terminal elements over to the
+    next `finish` or to `resume`. A terminal element written by the putter
+    right before it crashed is put again.
+
+    Elements must be counted under the same lock as they are taken from
+    the queue, otherwise they are counted for the wrong epoch. Up to
+    `max_epochs` epochs can be in flight at the same time.
+
+    Workers that pass their slot (one of `nslots`) to `take` and `finish`
+    record the epoch of the element they hold, so the element of a crashed
+    worker is finished exactly once with `release` and `finish`."""
+
+    max_epochs = 64
+
+    def __init__(self, nslots: int = 0):
+        self._cond = mp.Condition()
+        # Epoch of the element each slot holds, -1 for none
+        self._slots = mp.Array("q", [-1] * nslots, lock=False)
+        # Epoch of the next element taken from the queue and
+        # number of epochs whose terminal element has been put
+        self._taken = mp.Value("q", 0, lock=False)
+        self._done = mp.Value("q", 0, lock=False)
+        # Ring over the epochs in flight: elements not finished yet
+        # and the epoch id of the terminal element, once it was taken
+        self._pending = mp.Array("q", self.max_epochs, lock=False)
+        self._ids = mp.Array("q", self.max_epochs, lock=False)
+        # Whether a worker is putting terminal elements and its slot
+        self._putting = mp.Value("b", 0, lock=False)
+        self._putter = mp.Value("q", -1, lock=False)
+
+    def take(self, element, shutdown_event, slot: int = None):
+        """Count an element taken from the input queue. Returns its epoch and
+        the terminal elements that the caller has to put with `put_terminals`
+        once it released the lock of the queue. Raises `Empty` if the
+        shutdown event is set while the ring is full."""
+        with self._cond:
+            while not self._cond.wait_for(
+                lambda: self._taken.value - self._done.value < self.max_epochs,
+                timeout=1,
+            ):
+                if shutdown_event.is_set():
+                    raise Empty
+            epoch = self._taken.value
+            i = epoch % self.max_epochs
+            if not isinstance(element, TerminateQueue):
+                self._pending[i] += 1
+                if slot is not None:
+                    self._slots[slot] = epoch
+                return epoch, []
+            self._ids[i] = -1 if element.epoch is None else element.epoch
+            self._taken.value += 1
+            return epoch, self.__complete(slot)
+
+    def is_open(self, epoch: int) -> bool:
+        """Whether the outputs of `epoch` may be put."""
+        return self._done.value >= epoch
+
+    def wait_epoch(self, epoch: int, shutdown_event) -> bool:
+        """Block until the outputs of `epoch` may be put,
+        returns False if the shutdown event is set before."""
+        with self._cond:
+            while not self._cond.wait_for(
+                lambda: self._done.value >= epoch, timeout=1
+            ):
+                if shutdown_event.is_set():
+                    return False
+        return True
+
+    def finish(self, epoch: int, put_terminal, slot: int = None):
+        """Count an element of `epoch` as finished, once its output has been
+        put or it was dropped. Puts the terminal element with `put_terminal`
+        if it was the last element of the epoch. With `slot` the slot is
+        cleared, elements released from it are not counted again."""
+        with self._cond:
+            if slot is not None:
+                if self._slots[slot] < 0:
+                    return
+                self._slots[slot] = -1
+            self._pending[epoch % self.max_epochs] -= 1
+            terminals = self.__complete(slot)
+        self.put_terminals(terminals, put_terminal, slot)
+
+    def release(self, slot: int) -> int:
+        """Clear the slot of a crashed worker, returns the epoch of the
+        element it held (-1 for none), to be finished without the slot.
+        If the worker was putting terminal elements, the remaining ones
+        are put by the next `finish` or `resume`."""
+        with self._cond:
+            epoch = self._slots[slot]
+            self._slots[slot] = -1
+            if self._putting.value and self._putter.value == slot:
+                self._putting.value = 0
+        return epoch
+
+    def resume(self, put_terminal):
+        """Put the terminal elements of the complete epochs with
+        `put_terminal`, eg. those left by a crashed putter."""
+        with self._cond:
+            terminals = self.__complete()
+        self.put_terminals(terminals, put_terminal)
+
+    def put_terminals(self, terminals: list, put_terminal, slot: int = None):
+        """Put the terminal elements with `put_terminal` in order and the
+        terminal elements of the epochs that completed in the meantime.
+        `slot` is the slot given to the `take` or `finish` that returned
+        the terminal elements."""
+        while terminals:
+            for terminal in terminals:
+                put_terminal(terminal)
+                with self._cond:
+                    self._done.value += 1
+                    self._cond.notify_all()
+            with self._cond:
+                self._putting.value = 0
+                terminals = self.__complete(slot)
+
+    def __complete(self, slot: int = None) -> list:
+        """Terminal elements of the complete epochs that have not been put,
+        the caller (in `slot`) becomes the putter. Called under the lock."""
+        if self._putting.value:
+            return []
+        terminals = []
+        epoch = self._done.value
+        while epoch < self._taken.value:
+            i = epoch % self.max_epochs
+            if self._pending[i]:
+                break
+            epoch_id = self._ids[i]
+            terminals.append(TerminateQueue(None if epoch_id == -1 else epoch_id))
+            epoch += 1
+        if terminals:
+            self._putting.value = 1
+            self._putter.value = -1 if slot is None else slot
+        return terminals
+
+
+def put_flushed(queue, obj, block: bool = True, timeout: float = None):
+    """Put `obj` into the queue so that it has been written to the pipe when
+    the call returns. The feeder thread of `multiprocessing.Queue` is
+    bypassed, because puts from the feeder threads of different processes
+    can overtake each other."""
+    # Queues that wrap the elements (`ByteQueue`) implement it themselves
+    if hasattr(queue, "put_flushed"):
+        return queue.put_flushed(obj, block, timeout)
+    if getattr(queue, "synchronous_put", False) or not hasattr(queue, "_writer"):
+        return queue.put(obj, block, timeout)
+    write_flushed(queue, obj, block, timeout)
+
+
+def write_flushed(queue, obj, block: bool = True, timeout: float = None):
+    """Write `obj` to the pipe of a `multiprocessing.Queue`
+    without the feeder thread. The pipe is written directly,
+    as `_send_bytes` may be wrapped for the feeder thread."""
+    if queue._closed:
+        raise ValueError(f"Queue {queue!r} is closed")
+    if not queue._sem.acquire(block, timeout):
+        raise Full
+    try:
+        payload = ForkingPickler.dumps(obj)
+        with queue._wlock:
+            queue._writer.send_bytes(payload)
+    except BaseException:
+        queue._sem.release()
+        raise
@@ -0,0 +1,62 @@
+from collections import deque
+
+import numpy as np
+import torch
+
+# "copy": received elements are cloned, so they do not share memory
+#   with the element the previous step put in the queue.
+# "move": an element put in a queue belongs to the receiving step
+#   and is used in place.
+OWNERSHIP_MODES = ("copy", "move")
+
+
+class UseAfterPutError(RuntimeError):
+    pass
+
+
+def _leaves(element):
+    if isinstance(element, (torch.Tensor, np.ndarray)):
+        yield element
+    elif isinstance(element, dict):
+        for value in element.values():
+            yield from _leaves(value)
+    elif isinstance(element, (list, tuple, set)):
+        for value in element:
+            yield from _leaves(value)
+    elif hasattr(element, "to_dict") and callable(element.to_dict):
+        yield from _leaves(element.to_dict())
+
+
+def _fingerprint(leaf):
+    if isinstance(leaf, torch.Tensor):
+        # The version counter is increased by every in-place operation
+        # in this process, changes by the receiving process do not count.
+        # The data pointer is not used, because the queue moves the storage
+        # to shared memory when the tensor is pickled.
+        return leaf._version
+    return hash(leaf.tobytes())
+
+
+class OwnershipChecker:
+    """Debug helper for the "move" ownership mode: remembers the
+    tensors and arrays of the last `history` elements put by a step
+    and raises `UseAfterPutError` if the step modified one of them
+    after it was put in the queue."""
+
+    def __init__(self, history: int = 8):
+        self.put_elements = deque(maxlen=history)
+
+    def record(self, element):
+        self.put_elements.append(
+            [(leaf, _fingerprint(leaf)) for leaf in _leaves(element)]
+        )
+
+    def check(self, workername: str):
+        for leaves in self.put_elements:
+            for leaf, fingerprint in leaves:
+                if _fingerprint(leaf) != fingerprint:
+                    raise UseAfterPutError(
+                        f"""\
+{workername} modified a {type(leaf).__name__} of shape {tuple(leaf.shape)} \
+after putting it in the output queue."""
+                    )
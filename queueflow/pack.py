@@ -1,9 +1,14 @@
+import time
+from bisect import bisect_right
 from collections.abc import Iterable
 from multiprocessing.queues import Empty
+from typing import List
 
 from torch.multiprocessing import Value
 
+from .handlers import serialize
 from .logger import logger
+from .progress import ProgressLog, with_last
 from .step_base import StepBase
 from .terminate_queue import TerminateQueue
 
@@ -15,13 +20,19 @@ class UnpackStep(StepBase):
     def __init__(self, *args, **kwargs):
         kwargs["name"] = "Unpack"
         super().__init__(*args, **kwargs)
+        self.progress = ProgressLog()
 
-    def __handle_terminal(self):
+    def inputs_complete(self, n_outputs: int) -> int:
+        if self.nworkers > 1:
+            return super().inputs_complete(n_outputs)
+        return self.progress.inputs_complete(n_outputs)
+
+    def __handle_terminal(self, terminal: TerminateQueue):
         logger.debug(
             f"""\
 {self.workername} push terminal element into output queue {id(self.outq)}."""
         )
-        self.safe_put(self.outq, TerminateQueue())
+        self.safe_put(self.outq, terminal)
 
     def _worker(self, shutdown_event):
         self.set_workername()
@@ -30,8 +41,8 @@ class UnpackStep(StepBase):
             if shutdown_event.is_set():
                 break
             try:
-                wkin = self.inq.get(block=True, timeout=0.05)
-                wkin = self._clone_tensors(wkin)
+                wkin = self.safe_get(self.inq)
+                wkin = self._take_ownership(wkin)
             except Empty:
                 continue
             logger.debug(
@@ -39,48 +50,98 @@ class UnpackStep(StepBase):
 {self.workername} working type {type(wkin)} from queue {id(self.inq)}."""
             )
             if isinstance(wkin, TerminateQueue):
-                self.__handle_terminal()
+                self.__handle_terminal(wkin)
                 continue
 
             if not isinstance(wkin, Iterable):
                 errormsg = f"""\
 {self.workername} cannot iterate over element type {type(wkin)}."""
-                self.error_queue.put((errormsg, wkin, ValueError))
+                self.error_queue.put((errormsg, serialize(wkin), "ValueError", ""))
                 break
             logger.debug(f"{self.workername} got element of element type {type(wkin)}.")
-            for element in wkin:
+            start = time.perf_counter()
+            for element, last in with_last(wkin):
                 logger.debug(
                     f"""\
 {self.workername} push element of type {type(wkin)} into output queue."""
                 )
+                self.progress.record_output(self.progress.n_inputs + last)
                 self.safe_put(self.outq, element)
+            self.progress.n_inputs += 1
+            self._trace("unpack", start)
             del wkin
         self._close_queues()
         logger.info(f"{self.workername} terminating")
 
 
 class PackStep(StepBase):
-    """Takes an iterable from the incoming queue and
-    puts the elements one-by-one in the outgoing queue."""
+    """Collects n elements from the incoming queue and
+    puts them as a list in the outgoing queue.
+
+    With `collate_fn` (eg. `queueflow.default_collate`) the list is
+    collated into a single batch before it is put in the queue.
 
-    def __init__(self, nelements: Value, *args, **kwargs):
+    With `max_wait` a partial list is put once its first element
+    has waited for `max_wait` seconds."""
+
+    def __init__(
+        self,
+        nelements: Value,
+        *args,
+        collate_fn: callable = None,
+        max_wait: float = None,
+        **kwargs,
+    ):
         kwargs["name"] = f"Pack({nelements.value})"
         super().__init__(*args, **kwargs)
         self.nelements = nelements
+        self.collate_fn = collate_fn
+        self.max_wait = max_wait
         self.collected_elements = []
+        # Time the first of the collected elements arrived
+        self.collected_since = None
+        self.progress = ProgressLog()
+
+    def inputs_complete(self, n_outputs: int) -> int:
+        if self.nworkers > 1:
+            return super().inputs_complete(n_outputs)
+        return self.progress.inputs_complete(n_outputs)
 
-    def __handle_terminal(self):
+    def __time_to_flush(self):
+        if self.max_wait is None or not self.collected_elements:
+            return None
+        return max(self.collected_since + self.max_wait - time.monotonic(), 0)
+
+    def __put_collected(self):
+        """Put the collected elements, collated by `collate_fn` if given,
+        in the outgoing queue."""
+        elements, self.collected_elements = self.collected_elements, []
+        # Start of the collection on the clock of the trace
+        collected_for = time.monotonic() - self.collected_since
+        start = time.perf_counter() - collected_for
+        self.collected_since = None
+        if self.collate_fn is not None:
+            try:
+                elements = self.collate_fn(elements)
+            except Exception as error:
+                self.handle_error(error, elements)
+                return
+        self._trace("pack", start, n=len(elements))
+        self.progress.record_output(self.progress.n_inputs)
+        self.safe_put(self.outq, elements)
+
+    def __handle_terminal(self, terminal: TerminateQueue):
         if len(self.collected_elements) > 0:
             logger.debug(
                 f"""\
 {self.workername} put remainder of size {len(self.collected_elements)} into output queue."""
             )
-            self.safe_put(self.outq, self.collected_elements)
+            self.__put_collected()
         logger.debug(
             f"""\
 {self.workername} terminal element into output queue {id(self.outq)}."""
         )
-        self.safe_put(self.outq, TerminateQueue())
+        self.safe_put(self.outq, terminal)
 
     def _worker(self, shutdown_event):
         self.set_workername()
@@ -89,9 +150,15 @@ class PackStep(StepBase):
             if shutdown_event.is_set():
                 break
             try:
-                wkin = self.inq.get(block=True, timeout=0.05)
-                wkin = self._clone_tensors(wkin)
+                wkin = self.safe_get(self.inq, timeout=self.__time_to_flush())
+                wkin = self._take_ownership(wkin)
             except Empty:
+                if self.__time_to_flush() == 0:
+                    logger.debug(
+                        f"""\
+{self.workername} max_wait expired, put {len(self.collected_elements)} elements."""
+                    )
+                    self.__put_collected()
                 continue
             logger.debug(
                 f"""\
@@ -99,14 +166,17 @@ class PackStep(StepBase):
             )
 
             if isinstance(wkin, TerminateQueue):
-                self.__handle_terminal()
+                self.__handle_terminal(wkin)
                 continue
 
             logger.debug(
                 f"""\
 {self.workername} storing element of type {type(wkin)}."""
             )
+            if not self.collected_elements:
+                self.collected_since = time.monotonic()
             self.collected_elements.append(wkin)
+            self.progress.n_inputs += 1
 
             if len(self.collected_elements) == self.nelements.value:
                 logger.debug(
@@ -114,34 +184,156 @@ class PackStep(StepBase):
 {self.workername} push list of type \
 {type(self.collected_elements[-1])} into output queue {id(self.outq)}."""
                 )
-                self.safe_put(self.outq, self.collected_elements)
-                self.collected_elements = []
+                self.__put_collected()
             del wkin
         self._close_queues()
 
 
 class RepackStep(StepBase):
     """Takes an iterable from the incoming queue,
-    collects n elements and packs them as a list in the outgoing queue."""
+    collects n elements and packs them as a list in the outgoing queue.
+
+    With `collate_fn` (eg. `queueflow.default_collate`) the list is
+    collated into a single batch before it is put in the queue.
+
+    With `cost_fn` and `budget` a batch is put as soon as the summed cost
+    of its elements (eg. the number of nodes of graphs) reaches the budget
+    or adding the next element would exceed it, but it never holds more
+    than n elements. An element that exceeds the budget on its own
+    is put as a batch of one. `buckets` are the boundaries of size classes
+    of the cost, each size class is collected into separate batches.
+    With buckets the elements are not put in the order of the input,
+    a `Sequence` or `Parallel` that requires ordered outputs raises a
+    ValueError.
 
-    def __init__(self, nelements: Value, *args, **kwargs):
+    With `max_wait` a partial batch is put once its first element
+    has waited for `max_wait` seconds."""
+
+    def __init__(
+        self,
+        nelements: Value,
+        *args,
+        collate_fn: callable = None,
+        cost_fn: callable = None,
+        budget: float = None,
+        buckets: List[float] = None,
+        max_wait: float = None,
+        **kwargs,
+    ):
+        if (cost_fn is None) != (budget is None):
+            raise ValueError("cost_fn and budget must be given together.")
+        if buckets and cost_fn is None:
+            raise ValueError("Bucketing requires a cost_fn.")
         kwargs["name"] = f"Repack({nelements.value})"
         super().__init__(*args, **kwargs)
         self.nelements = nelements
-        self.collected_elements = []
+        self.collate_fn = collate_fn
+        self.cost_fn = cost_fn
+        self.budget = budget
+        self.max_wait = max_wait
+        self.bucket_bounds = sorted(buckets) if buckets else []
+        # Elements and summed cost of the batch in collection per size class
+        self.collected_elements = [[] for _ in range(len(self.bucket_bounds) + 1)]
+        self.collected_cost = [0] * len(self.collected_elements)
+        self.collected_since = [None] * len(self.collected_elements)
+        self.progress = ProgressLog()
 
-    def __handle_terminal(self):
-        if len(self.collected_elements) > 0:
-            logger.debug(
-                f"""\
-{self.workername} put remainder of size {len(self.collected_elements)} into output queue."""
-            )
-            self.safe_put(self.outq, self.collected_elements)
+    @property
+    def ordered(self) -> bool:
+        return not self.bucket_bounds
+
+    @ordered.setter
+    def ordered(self, ordered: bool):
+        if ordered and self.bucket_bounds:
+            raise ValueError(f"{self.name} puts the batches of its buckets out of order.")
+
+    def inputs_complete(self, n_outputs: int) -> int:
+        if self.bucket_bounds or self.nworkers > 1:
+            return super().inputs_complete(n_outputs)
+        return self.progress.inputs_complete(n_outputs)
+
+    def __time_to_flush(self):
+        if self.max_wait is None:
+            return None
+        since = [t for t in self.collected_since if t is not None]
+        if not since:
+            return None
+        return max(min(since) + self.max_wait - time.monotonic(), 0)
+
+    def __put_expired(self):
+        now = time.monotonic()
+        for ibucket, since in enumerate(self.collected_since):
+            if since is not None and since + self.max_wait <= now:
+                logger.debug(
+                    f"{self.workername} max_wait expired for size class {ibucket}."
+                )
+                self.__put_collected(ibucket)
+
+    def __put_collected(self, ibucket: int, n_inputs_complete: int = None):
+        """Put the elements collected in the size class `ibucket`, collated by
+        `collate_fn` if given, in the outgoing queue. By default all inputs
+        the elements of which have been collected are complete."""
+        elements = self.collected_elements[ibucket]
+        self.collected_elements[ibucket] = []
+        self.collected_cost[ibucket] = 0
+        # Start of the collection on the clock of the trace
+        collected_for = time.monotonic() - self.collected_since[ibucket]
+        start = time.perf_counter() - collected_for
+        self.collected_since[ibucket] = None
+        logger.debug(
+            f"""{self.workername} push list of type {type(elements[-1])} \
+with {len(elements)} elements into output queue {id(self.outq)}."""
+        )
+        if self.collate_fn is not None:
+            try:
+                elements = self.collate_fn(elements)
+            except Exception as error:
+                self.handle_error(error, elements)
+                return
+        self._trace("repack", start, n=len(elements), bucket=ibucket)
+        if n_inputs_complete is None:
+            n_inputs_complete = self.progress.n_inputs
+        self.progress.record_output(n_inputs_complete)
+        self.safe_put(self.outq, elements)
+        self.count_out += 1
+
+    def __collect(self, element, last: bool):
+        """Collect the element, `last` marks the last element of an input."""
+        if self.cost_fn is None:
+            cost, ibucket = 1, 0
+        else:
+            cost = self.cost_fn(element)
+            ibucket = bisect_right(self.bucket_bounds, cost)
+        collected = self.collected_elements[ibucket]
+        if (
+            self.budget is not None
+            and collected
+            and self.collected_cost[ibucket] + cost > self.budget
+        ):
+            self.__put_collected(ibucket)
+        collected = self.collected_elements[ibucket]
+        if not collected:
+            self.collected_since[ibucket] = time.monotonic()
+        collected.append(element)
+        self.collected_cost[ibucket] += cost
+        if len(collected) >= self.nelements.value or (
+            self.budget is not None and self.collected_cost[ibucket] >= self.budget
+        ):
+            self.__put_collected(ibucket, self.progress.n_inputs + last)
+
+    def __handle_terminal(self, terminal: TerminateQueue):
+        for ibucket, collected in enumerate(self.collected_elements):
+            if len(collected) > 0:
+                logger.debug(
+                    f"""\
+{self.workername} put remainder of size {len(collected)} into output queue."""
+                )
+                self.__put_collected(ibucket)
         logger.debug(
             f"""\
 {self.workername} terminal element into output queue {id(self.outq)}."""
         )
-        self.safe_put(self.outq, TerminateQueue())
+        self.safe_put(self.outq, terminal)
         logger.warning(
             f"""\
 {self.workername} finished with iterable (in {self.count_in}/out {self.count_out})"""
@@ -155,22 +347,24 @@ class RepackStep(StepBase):
             if shutdown_event.is_set():
                 break
             try:
-                wkin = self.inq.get(block=True, timeout=0.05)
+                wkin = self.safe_get(self.inq, timeout=self.__time_to_flush())
             except KeyboardInterrupt:
                 break
             except Empty:
+                if self.max_wait is not None:
+                    self.__put_expired()
                 continue
             logger.debug(
                 f"""
 {self.workername} working on type {type(wkin)} from queue {id(self.inq)}."""
             )
             if isinstance(wkin, TerminateQueue):
-                self.__handle_terminal()
+                self.__handle_terminal(wkin)
                 continue
             if not isinstance(wkin, Iterable):
                 errormsg = f"""\
 {self.workername} cannot iterate over element type {type(wkin)}."""
-                self.error_queue.put((errormsg, wkin, ValueError))
+                self.error_queue.put((errormsg, serialize(wkin), "ValueError", ""))
                 break
             self.count_in += 1
             logger.debug(
@@ -178,16 +372,12 @@ class RepackStep(StepBase):
 {self.workername} storing element of type {type(wkin)} \
 (len {len(wkin) if hasattr(wkin,'__len__') else '?'})."""
             )
-            for element in wkin:
-                self.collected_elements.append(element)
-                if len(self.collected_elements) == self.nelements.value:
-                    logger.debug(
-                        f"""\
-{self.workername} push list of type {type(self.collected_elements[-1])} \
-with {self.nelements.value} elements into output queue {id(self.outq)}."""
-                    )
-                    self.safe_put(self.outq, self.collected_elements)
-                    self.collected_elements = []
-                    self.count_out += 1
+            for element, last in with_last(wkin):
+                try:
+                    self.__collect(element, last)
+                except Exception as error:
+                    self.handle_error(error, element)
+                    break
+            self.progress.n_inputs += 1
             del wkin
         self._close_queues()
@@ -0,0 +1,329 @@
+from multiprocessing.connection import wait
+from multiprocessing.queues import Empty
+
+from torch import multiprocessing as mp
+
+from .logger import logger
+from .shutdown_event import get_or_shutdown
+from .step_base import StepBase
+from .terminate_queue import TerminateQueue
+from .thread_step import QUEUE_TYPES, ThreadQueue, ThreadStep
+
+SPLIT_MODES = ("broadcast", "route")
+JOIN_MODES = ("zip", "merge")
+
+
+class Parallel(StepBase):
+    """Runs several branches of steps side by side as one step of a `Sequence`.
+
+    Each branch is a step, a list of steps and queues like the arguments
+    of a `Sequence` or an empty list to pass the elements on unchanged.
+    The branches can be given as a dict, then `route_fn` may return
+    the keys and `zip` puts dicts instead of tuples.
+
+    Split modes:
+    - `broadcast`: every element is put into each branch, so the steps
+      before the `Parallel` run once per element for all branches.
+    - `route`: every element is put into the branch with the index
+      (or key) returned by `route_fn(element)`. A predicate routes
+      to the branches 0 (False) and 1 (True).
+
+    Join modes:
+    - `zip`: one output is taken from each branch and the outputs are put
+      together as a tuple. The branches must put exactly one output per
+      input, their steps are switched to the ordered mode.
+    - `merge`: the outputs of the branches are put as they arrive, a
+      `Sequence` with `ordered` raises a ValueError.
+
+    The terminal element is passed to every branch and is put once
+    all branches have passed it on, so epochs do not mix."""
+
+    def __init__(
+        self,
+        *branches,
+        split: str = "broadcast",
+        route_fn: callable = None,
+        join: str = "zip",
+        queue_type: callable = None,
+        name: str = None,
+    ):
+        if split not in SPLIT_MODES:
+            raise ValueError(f"split must be one of {SPLIT_MODES}")
+        if join not in JOIN_MODES:
+            raise ValueError(f"join must be one of {JOIN_MODES}")
+        if (split == "route") != (route_fn is not None):
+            raise ValueError("route_fn must be given for and only for split='route'.")
+        if split == "route" and join == "zip":
+            raise ValueError("Routed branches can only be joined with join='merge'.")
+        if len(branches) == 1 and isinstance(branches[0], dict):
+            self.keys = list(branches[0].keys())
+            branches = list(branches[0].values())
+        else:
+            self.keys = None
+        if not branches:
+            raise ValueError("Parallel needs at least one branch.")
+        super().__init__(
+            nworkers=0, name=f"Parallel({split},{join})" if name is None else name
+        )
+        self.split = split
+        self.route_fn = route_fn
+        self.join = join
+        self.ordered = False
+        self.queue_type = mp.Queue if queue_type is None else queue_type
+        self.chains = [self.__chain(branch) for branch in branches]
+        self.branch_steps = [
+            step
+            for chain in self.chains
+            for step in chain
+            if isinstance(step, StepBase)
+        ]
+        if join == "zip":
+            for step in self.branch_steps:
+                if step.on_error != "raise":
+                    raise ValueError(
+                        f"{step.name} drops elements, which join='zip' can not pair."
+                    )
+                if hasattr(step, "ordered"):
+                    step.ordered = True
+        # One process distributes the elements to the branches,
+        # one collects the outputs of the branches
+        self.processes = [
+            mp.Process(target=self._split, daemon=True, args=(self.shutdown_event,)),
+            mp.Process(target=self._join, daemon=True, args=(self.shutdown_event,)),
+        ]
+
+    def __chain(self, branch):
+        """Insert the queues around and in between the steps of the branch."""
+        if isinstance(branch, (StepBase, *QUEUE_TYPES)):
+            branch = [branch]
+        chain = []
+        for elem in branch:
+            assert isinstance(elem, (*QUEUE_TYPES, StepBase))
+            if isinstance(elem, StepBase) and (
+                not chain or isinstance(chain[-1], StepBase)
+            ):
+                # Adjacent thread steps hand over the elements directly
+                if (
+                    isinstance(elem, ThreadStep)
+                    and chain
+                    and isinstance(chain[-1], ThreadStep)
+                ):
+                    chain.append(ThreadQueue(1))
+                else:
+                    chain.append(self.queue_type(1))
+            chain.append(elem)
+        if not chain or isinstance(chain[-1], StepBase):
+            chain.append(self.queue_type(1))
+        for i, elem in enumerate(chain):
+            assert isinstance(elem, QUEUE_TYPES if i % 2 == 0 else StepBase)
+        return chain
+
+    @property
+    def branch_inqs(self):
+        return [chain[0] for chain in self.chains]
+
+    @property
+    def branch_outqs(self):
+        return [chain[-1] for chain in self.chains]
+
+    def connect_to_sequence(self, input_queue, output_queue, error_queue):
+        super().connect_to_sequence(input_queue, output_queue, error_queue)
+        for chain in self.chains:
+            for i, step in enumerate(chain):
+                if not isinstance(step, StepBase):
+                    continue
+                # Pass on the settings of the Sequence
+                step.ownership = self.ownership
+                step.check_ownership = self.check_ownership
+                step.tracer = self.tracer
+                if self.ordered and hasattr(step, "ordered"):
+                    step.ordered = True
+                step.connect_to_sequence(
+                    input_queue=chain[i - 1],
+                    output_queue=chain[i + 1],
+                    error_queue=error_queue,
+                )
+
+    def start(self):
+        # Start the threads last, see `Sequence.start`
+        super().start()
+        for step in sorted(self.branch_steps, key=lambda s: isinstance(s, ThreadStep)):
+            step.start()
+
+    def stop(self):
+        for chain in self.chains:
+            for queue in chain[::2]:
+                while True:
+                    try:
+                        queue.get(block=False)
+                    except (Empty, FileNotFoundError):
+                        break
+        super().stop()
+        for step in self.branch_steps:
+            step.stop()
+
+    def process_status(self):
+        return (sum([p.is_alive() for p in self.processes]), len(self.processes))
+
+    def respawn(self) -> int:
+        return sum(step.respawn() for step in self.branch_steps)
+
+    @property
+    def ordered(self) -> bool:
+        return self._ordered
+
+    @ordered.setter
+    def ordered(self, ordered: bool):
+        if ordered and self.join == "merge":
+            raise ValueError(f"{self.name} merges the outputs of the branches out of order.")
+        self._ordered = ordered
+
+    def inputs_complete(self, n_outputs: int) -> int:
+        # Zipped branches put one output per input in order
+        if self.join != "zip":
+            return super().inputs_complete(n_outputs)
+        return n_outputs
+
+    def __route(self, element) -> int:
+        key = self.route_fn(element)
+        if self.keys is not None:
+            return self.keys.index(key)
+        return int(key)
+
+    def _split(self, shutdown_event):
+        self.set_workername()
+        logger.debug(
+            f"{self.workername} start splitting into {len(self.chains)} branches."
+        )
+        while not shutdown_event.is_set():
+            try:
+                wkin = self.safe_get(self.inq)
+            except Empty:
+                continue
+            except KeyboardInterrupt:
+                break
+            if isinstance(wkin, TerminateQueue):
+                logger.debug(
+                    f"{self.workername} push terminal element into all branches."
+                )
+                for queue in self.branch_inqs:
+                    self.safe_put(queue, wkin)
+                self.count_in = 0
+                continue
+            self.count_in += 1
+            if self.split == "broadcast":
+                targets = range(len(self.chains))
+            else:
+                try:
+                    targets = [self.__route(wkin)]
+                except Exception as error:
+                    self.handle_error(error, wkin)
+                    break
+            for n, ibranch in enumerate(targets):
+                # Used in place by the branches in the "move" mode,
+                # so each branch needs its own copy
+                if n > 0 and self.ownership == "move":
+                    element = self._clone_tensors(wkin)
+                else:
+                    element = wkin
+                self.safe_put(self.branch_inqs[ibranch], element)
+            del wkin
+        self.__close(self.inq, *self.branch_inqs)
+
+    def _join(self, shutdown_event):
+        self.set_workername()
+        logger.debug(f"{self.workername} start joining {len(self.chains)} branches.")
+        try:
+            if self.join == "zip":
+                self.__zip(shutdown_event)
+            else:
+                self.__merge(shutdown_event)
+        except KeyboardInterrupt:
+            pass
+        self.__close(self.outq, *self.branch_outqs)
+
+    def __zip(self, shutdown_event):
+        while not shutdown_event.is_set():
+            outputs = []
+            for queue in self.branch_outqs:
+                while not shutdown_event.is_set():
+                    try:
+                        outputs.append(get_or_shutdown(queue, shutdown_event))
+                        break
+                    except Empty:
+                        continue
+            if shutdown_event.is_set():
+                break
+            terminals = [isinstance(out, TerminateQueue) for out in outputs]
+            if all(terminals):
+                self.__finish_epoch(outputs[0])
+                continue
+            try:
+                if any(terminals):
+                    raise ValueError(f"""\
+Branches {[i for i, t in enumerate(terminals) if t]} of {self.name} finished the \
+iterable before the others, zipped branches must put one output per input.""")
+            except ValueError as error:
+                self.handle_error(error, outputs)
+                break
+            if self.keys is not None:
+                self.safe_put(self.outq, dict(zip(self.keys, outputs)))
+            else:
+                self.safe_put(self.outq, tuple(outputs))
+            self.count_out += 1
+
+    def __merge(self, shutdown_event):
+        queues = self.branch_outqs
+        # Terminal elements of the branches that finished the current iterable,
+        # these branches are not read until all branches finished it.
+        terminals = [None] * len(queues)
+        while not shutdown_event.is_set():
+            ready = self.__readable(
+                [q for q, t in zip(queues, terminals) if t is None], shutdown_event
+            )
+            for ibranch, queue in enumerate(queues):
+                if terminals[ibranch] is not None or queue not in ready:
+                    continue
+                try:
+                    out = queue.get(block=True, timeout=0.05)
+                except Empty:
+                    continue
+                if isinstance(out, TerminateQueue):
+                    terminals[ibranch] = out
+                    continue
+                self.safe_put(self.outq, out)
+                self.count_out += 1
+            if all(t is not None for t in terminals):
+                self.__finish_epoch(terminals[0])
+                terminals = [None] * len(queues)
+
+    @staticmethod
+    def __readable(queues, shutdown_event) -> list:
+        """The queues that may hold an element. Queues backed by a pipe are
+        waited for with `select` together with the shutdown event, like in
+        `get_or_shutdown`, other queues are polled in short intervals."""
+        readers = [getattr(queue, "_reader", None) for queue in queues]
+        shutdown_reader = getattr(shutdown_event, "reader", None)
+        if None in readers or shutdown_reader is None:
+            ready = [queue for queue in queues if not queue.empty()]
+            if not ready:
+                shutdown_event.wait(0.005)
+            return ready
+        ready = wait(readers + [shutdown_reader])
+        return [queue for queue, reader in zip(queues, readers) if reader in ready]
+
+    def __finish_epoch(self, terminal: TerminateQueue):
+        logger.debug(f"""\
+{self.workername} all branches finished, push terminal element into output queue.""")
+        self.safe_put(self.outq, terminal)
+        logger.debug(f"""\
+{self.workername} finished with iterable (out {self.count_out})""")
+        self.count_out = 0
+
+    def __close(self, *queues):
+        for queue in queues:
+            queue.close()
+            queue.join_thread()
+        self.error_queue.close()
+        self.error_queue.join_thread()
+        logger.debug(f"""{self.workername} queues closed""")
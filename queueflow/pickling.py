@@ -0,0 +1,41 @@
+"""Pickling with out-of-band buffers, used to send elements over the
+network (`RemoteStep`) and to store them on disk (`DiskCache`)."""
+import io
+import pickle
+
+import torch
+
+
+def _rebuild_tensor(buffer, dtype, shape):
+    return torch.frombuffer(buffer, dtype=dtype).reshape(shape)
+
+
+class _OutOfBandPickler(pickle.Pickler):
+    """Pickles tensors and numpy arrays with out-of-band buffers,
+    so their data is not copied into the pickle stream."""
+
+    def reducer_override(self, obj):
+        if isinstance(obj, torch.Tensor) and obj.layout == torch.strided:
+            tensor = obj.detach().cpu().contiguous()
+            if tensor.numel() == 0:
+                return NotImplemented
+            data = tensor.reshape(-1).view(torch.uint8).numpy()
+            return _rebuild_tensor, (
+                pickle.PickleBuffer(data),
+                tensor.dtype,
+                tuple(tensor.shape),
+            )
+        return NotImplemented
+
+
+def dumps(obj):
+    """Returns the pickle stream and the raw out-of-band buffers of `obj`."""
+    buffers = []
+    stream = io.BytesIO()
+    _OutOfBandPickler(stream, 5, buffer_callback=buffers.append).dump(obj)
+    return stream.getvalue(), [buffer.raw() for buffer in buffers]
+
+
+def loads(stream, buffers):
+    """Rebuild the object, the tensors and arrays use the memory of `buffers`."""
+    return pickle.loads(stream, buffers=buffers)
@@ -1,8 +1,13 @@
+import time
+from collections import deque
+from functools import partial
 from collections.abc import Iterable
 from multiprocessing.queues import Empty
 
 from torch import multiprocessing as mp
 
+from . import trace
+from .errors import Failed, pool_call
 from .logger import logger
 from .step_base import StepBase
 from .terminate_queue import TerminateQueue
@@ -11,12 +16,29 @@ from .terminate_queue import TerminateQueue
 class PoolStep(StepBase):
     """Class for simple processing steps pooled over multiple workes.
     Each incoming object is processed by a multiple subprocesses
-    per worker into a single outgoing element."""
+    per worker into a single outgoing element.
+
+    If `min_workers` or `max_workers` differ from `nworkers` the size
+    of the pool can be changed by `scale` while the step is running.
+    The pool is then recreated before the next element is processed.
+
+    With `inflight > 1` up to `inflight` incoming elements are processed
+    by the pool at the same time, so the pool workers do not idle while
+    the slowest element of a chunk finishes. The output lists are still
+    put in the order of the incoming elements.
+
+    The elements an `on_error` policy drops are missing in the output
+    list. With `max_tasks` the processes of the pool are replaced after
+    that many elements, see `multiprocessing.Pool`."""
 
     def __init__(
         self,
         *args,
         nworkers: int,
+        min_workers: int = None,
+        max_workers: int = None,
+        inflight: int = 1,
+        max_tasks: int = None,
         **kwargs,
     ):
         # Spawn only one process with deamonize false that can spawn the Pool
@@ -25,6 +47,13 @@ class PoolStep(StepBase):
         # Make sure the contructor of the base class only initializes
         # one process that manages the pool
         self.n_pool_workers = nworkers
+        self.n_pool_target = mp.Value("i", nworkers)
+        self.min_workers = nworkers if min_workers is None else min_workers
+        self.max_workers = nworkers if max_workers is None else max_workers
+        assert 1 <= self.min_workers <= nworkers <= self.max_workers
+        assert inflight >= 1
+        self.inflight = inflight
+        self.max_tasks = max_tasks
         kwargs["nworkers"] = 1
         super().__init__(*args, **kwargs)
 
@@ -45,18 +74,140 @@ class PoolStep(StepBase):
             self.n_pool_workers,
         )
 
+    def scale(self, delta: int) -> bool:
+        n_old = self.n_pool_workers
+        n_new = min(max(n_old + delta, self.min_workers), self.max_workers)
+        if n_new == n_old:
+            return False
+        self.n_pool_target.value = n_new
+        self.n_pool_workers = n_new
+        logger.info(f"Scaled pool of {self.name} from {n_old} to {n_new} workers.")
+        return True
+
+    def inputs_complete(self, n_outputs: int) -> int:
+        return n_outputs
+
+    def __resize_pool(self):
+        n_pool_workers = self.n_pool_target.value
+        logger.debug(
+            f"{self.workername} resizing pool from {self.n_pool_workers}"
+            f" to {n_pool_workers} subprocesses"
+        )
+        self.pool.close()
+        self.pool.join()
+        self.n_pool_workers = n_pool_workers
+        self.pool = mp.Pool(self.n_pool_workers, maxtasksperchild=self.max_tasks)
+
+    def __submit(self, wkin):
+        if self.n_pool_target.value != self.n_pool_workers and not self.pending:
+            self.__resize_pool()
+        assert isinstance(wkin, Iterable)
+        logger.debug(
+            f"{self.workername} got element"
+            + f" {id(wkin)} of element type {type(wkin)}."
+        )
+        # Failures are returned per element, see `__drop_failed`
+        fn = partial(pool_call, self.workerfn, self.retries)
+        if self.tracer is not None and self.tracer.enabled:
+            # Record the calls in the processes of the pool as subtasks
+            fn = partial(trace.traced_call, self.workername, fn)
+        if self.cache is None:
+            lookups = None
+            wkout_async_res = self.pool.map_async(fn, wkin)
+        else:
+            # Only the elements without cached output go to the pool
+            wkin = list(wkin)
+            lookups = [self._cache_lookup(element) for element in wkin]
+            misses = [e for e, (_, hit, _) in zip(wkin, lookups) if not hit]
+            wkout_async_res = self.pool.map_async(fn, misses)
+        self.pending.append((wkin, wkout_async_res, time.perf_counter(), lookups))
+
+    def __merge_cached(self, lookups, computed):
+        """Output list from the cached outputs and the outputs of the pool,
+        the latter are stored in the cache."""
+        computed = iter(computed)
+        wkout = []
+        for key, hit, output in lookups:
+            if not hit:
+                output = next(computed)
+                if not isinstance(output, Failed):
+                    self._cache_store(key, output)
+            wkout.append(output)
+        return wkout
+
+    def __drop_failed(self, wkin, wkout):
+        """Output list without the outputs of the elements the worker
+        function failed on, None if the worker has to stop."""
+        if not any(isinstance(output, Failed) for output in wkout):
+            return wkout
+        kept = []
+        for element, output in zip(wkin, wkout):
+            if not isinstance(output, Failed):
+                kept.append(output)
+            elif not self._drop(output.error, element, output.traceback):
+                return None
+        return kept
+
+    def __emit_first(self, shutdown_event) -> bool:
+        """Wait for the oldest chunk in flight and put its output list
+        in the outgoing queue. Returns False if the worker has to stop."""
+        wkin, wkout_async_res, start, lookups = self.pending[0]
+        while not wkout_async_res.ready():
+            if shutdown_event.is_set():
+                return False
+            wkout_async_res.wait(1)
+        self.pending.popleft()
+        try:
+            wkout = wkout_async_res.get()
+        except Exception as error:
+            logger.warning(f"""{self.workername} got error""")
+            self.handle_error(error, wkin)
+            return False
+        self.metrics.add(work_time=time.perf_counter() - start)
+        self._trace("map", start, n=len(wkout))
+        if lookups is not None:
+            wkout = self.__merge_cached(lookups, wkout)
+        wkout = self.__drop_failed(wkin, wkout)
+        if wkout is None:
+            return False
+
+        logger.debug(
+            f"""\
+    {self.workername} push pool output list {id(wkout)} with \
+    element type {type(wkin)} into output queue {id(self.outq)}."""
+        )
+        # Put while there is no shutdown event
+        self.safe_put(self.outq, wkout)
+        self.count_out += 1
+        return True
+
     def _worker(self, shutdown_event):
         self.set_workername()
         logger.debug(
             f"{self.workername} pool  initalizing with"
             f" {self.n_pool_workers} subprocesses"
         )
-        self.pool = mp.Pool(self.n_pool_workers)
+        # Inherited by the processes of the pool
+        trace._pool_tracer = self.tracer
+        self.pool = mp.Pool(self.n_pool_workers, maxtasksperchild=self.max_tasks)
+        # Chunks submitted to the pool, oldest first
+        self.pending = deque()
 
         while not shutdown_event.is_set():
             try:
+                if self.pending and self.pending[0][1].ready():
+                    if not self.__emit_first(shutdown_event):
+                        break
+                    continue
+                if len(self.pending) >= self.inflight:
+                    self.pending[0][1].wait(1)
+                    continue
                 try:
-                    wkin = self.inq.get(block=True, timeout=0.05)
+                    # Poll for new input while chunks are in flight,
+                    # so finished chunks are emitted without delay.
+                    wkin = self.safe_get(
+                        self.inq, timeout=0.01 if self.pending else None
+                    )
                 except Empty:
                     continue
                 logger.debug(
@@ -65,11 +216,16 @@ class PoolStep(StepBase):
                 )
 
                 # If the process gets a TerminateQueue object,
-                # it terminates the pool and and puts the terminal element in
-                # in the outgoing queue.
+                # it waits for the chunks in flight and puts the terminal
+                # element in in the outgoing queue.
                 if isinstance(wkin, TerminateQueue):
                     logger.info(f"{self.workername} terminating")
-                    self.safe_put(self.outq, TerminateQueue())
+                    while self.pending:
+                        if not self.__emit_first(shutdown_event):
+                            break
+                    if self.pending:
+                        break
+                    self.safe_put(self.outq, wkin)
                     logger.warning(
                         f"""\
     {self.workername} finished with iterable (in {self.count_in}/out {self.count_out})"""
@@ -77,42 +233,13 @@ class PoolStep(StepBase):
                     self.count_in, self.count_out = 0, 0
                     continue
                 self.count_in += 1
-                wkin = self._clone_tensors(wkin)
-
-                assert isinstance(wkin, Iterable)
-                logger.debug(
-                    f"{self.workername} got element"
-                    + f" {id(wkin)} of element type {type(wkin)}."
-                )
-
+                wkin = self._take_ownership(wkin)
                 try:
-                    wkout_async_res = self.pool.map_async(
-                        self.workerfn,
-                        wkin,
-                    )
-                    while True:
-                        if wkout_async_res.ready():
-                            wkout = wkout_async_res.get()
-                            break
-                        elif shutdown_event.is_set():
-                            break
-                        wkout_async_res.wait(1)
-                    if shutdown_event.is_set():
-                        break
-
+                    self.__submit(wkin)
                 except Exception as error:
                     logger.warning(f"""{self.workername} got error""")
                     self.handle_error(error, wkin)
                     break
-
-                logger.debug(
-                    f"""\
-    {self.workername} push pool output list {id(wkout)} with \
-    element type {type(wkin)} into output queue {id(self.outq)}."""
-                )
-                # Put while there is no shutdown event
-                self.safe_put(self.outq, wkout)
-                self.count_out += 1
                 del wkin
             except KeyboardInterrupt:
                 break
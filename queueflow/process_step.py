@@ -1,8 +1,13 @@
+import os
+import threading
+import time
 from multiprocessing.queues import Empty
 
 from torch import multiprocessing as mp
 
+from .errors import DeadLetter
 from .logger import logger
+from .ordering import EpochGate, Turnstile, put_flushed
 from .step_base import StepBase
 from .terminate_queue import TerminateQueue
 
@@ -10,84 +15,340 @@ from .terminate_queue import TerminateQueue
 class ProcessStep(StepBase):
     """Class for simple processing steps.
     Each incoming object is processed by a
-    single worker into a single outgoing element."""
+    single worker into a single outgoing element.
+
+    If `min_workers` or `max_workers` differ from `nworkers`
+    the number of workers can be changed by `scale` (eg. by
+    the autoscaler of the `Sequence`) while the step is running.
+
+    With `ordered` the outputs are put in the order of the inputs,
+    even if there are multiple workers.
+
+    The end of an epoch is passed on by an `EpochGate`: workers that are
+    done with an epoch take the elements of the next one right away and
+    put their outputs once the terminal element has been put. Unordered
+    outputs are written by the feeder thread of each worker, the terminal
+    element is put once the feeder threads wrote the outputs before it.
+
+    Workers that exit without being retired (eg. killed by a segfault or
+    the OOM killer) are replaced by `respawn`, which the `Sequence` calls
+    periodically. The element the worker was processing is lost and handled
+    by `on_error`: "raise" stops the `Sequence`, "deadletter" collects a
+    `DeadLetter` without the element. Unordered
+    outputs are written by a feeder thread while the next element is
+    processed, a crashed worker can take them and the space they hold in
+    the output queue with it. Steps with an `on_error` policy other than
+    "raise" write their outputs before processing the next element.
+    With `max_tasks` each worker exits after that many elements and is
+    replaced, eg. to release memory leaked by the worker function."""
+
+    # Pid of the slots that are not used by a worker
+    FREE_SLOT = 0
 
     def __init__(
         self,
         *args,
+        min_workers: int = None,
+        max_workers: int = None,
+        ordered: bool = False,
+        max_tasks: int = None,
         **kwargs,
     ):
         super().__init__(*args, **kwargs)
-        self.finish_barrier = mp.Barrier(parties=self.nworkers)
-        self.sync_barrier = mp.Barrier(parties=self.nworkers)
-
-    def __handle_terminal(self):
-        logger.debug(f"{self.workername}  Got terminal element.")
-
-        # Put the terminal element back in the input queue
-        self.safe_put(self.inq, TerminateQueue())
-
-        # Make the first worker to reach the terminal element
-        # aquires the lock and waits for the other processes
-        # processes to finish
-        logger.debug(f"{self.workername} waiting at barrier.")
-        self.sync_barrier.reset()
-        if self.finish_barrier.wait() == 0:
-            assert isinstance(self.inq.get(), TerminateQueue)
-            self.safe_put(self.outq, TerminateQueue())
-            logger.debug(f"{self.workername} put terminal element in outq.")
-        if self.sync_barrier.wait() == 0:
-            self.finish_barrier.reset()
+        self.ordered = ordered
+        self.min_workers = self.nworkers if min_workers is None else min_workers
+        self.max_workers = self.nworkers if max_workers is None else max_workers
+        assert 1 <= self.min_workers <= self.nworkers <= self.max_workers
+        assert max_tasks is None or max_tasks >= 1
+        self.max_tasks = max_tasks
+        self.turnstile = Turnstile()
+        # Also keeps the epoch of the element each slot holds
+        self.epoch_gate = EpochGate(self.max_workers)
+        # Taking an element and counting it for its epoch is atomic
+        self.dequeue_lock = mp.Lock()
+        # Pid (thread id for threads) of the worker using each slot and the
+        # ticket of the element it holds, to finish the element of a crashed
+        # worker
+        self.slot_pids = mp.Array("q", self.max_workers, lock=False)
+        self.slot_tickets = mp.Array("q", self.max_workers, lock=False)
+        # Outputs put into the feeder thread of the worker of each slot
+        # and outputs the feeder thread wrote to the output queue
+        self.slot_puts = mp.Array("q", self.max_workers, lock=False)
+        self.slot_writes = mp.Array("q", self.max_workers, lock=False)
+
+        # Number of workers requested and number of running workers
+        self.scale_cond = mp.Condition()
+        self.n_target = mp.Value("i", self.nworkers, lock=False)
+        self.n_active = mp.Value("i", self.nworkers, lock=False)
+        # Set by the `Sequence`, forks the workers started while it runs
+        self.fork_server = None
+
+    def scale(self, delta: int) -> bool:
+        with self.scale_cond:
+            n_old = self.n_target.value
+            n_new = min(max(n_old + delta, self.min_workers), self.max_workers)
+            if n_new == n_old:
+                return False
+            n_start = n_new - self.n_active.value
+            if n_start > 0:
+                self.n_active.value += n_start
+                for _ in range(n_start):
+                    self.__start_worker()
+            # Surplus workers retire themselves before reading the next element
+            self.n_target.value = n_new
+            self.nworkers = n_new
+        logger.info(f"Scaled {self.name} from {n_old} to {n_new} workers.")
+        return True
+
+    def respawn(self) -> int:
+        """Replace the workers that exited without being retired.
+        Returns the number of new workers."""
+        n_new = 0
+        with self.scale_cond:
+            for process in list(self.processes):
+                if self.shutdown_event.is_set():
+                    break
+                if process.exitcode is None:
+                    continue
+                self.processes.remove(process)
+                slot = self.__find_slot(process.pid)
+                # Retired workers free their slot
+                if slot is None:
+                    continue
+                ticket, epoch = self.slot_tickets[slot], self.epoch_gate.release(slot)
+                # The outputs left in the feeder thread are lost
+                self.slot_writes[slot] = self.slot_puts[slot]
+                self.slot_pids[slot] = self.FREE_SLOT
+                if process.exitcode != 0:
+                    logger.warning(
+                        f"""\
+Worker {process.name} of {self.name} exited with code {process.exitcode}, \
+replacing it."""
+                    )
+                # Counted before the epoch of the worker can be finished
+                self.metrics.add(respawns=1)
+                # With on_error="raise" the epoch is not finished, the
+                # `Sequence` stops like after an error in the worker function
+                if epoch >= 0 and self.__report_lost(process, ticket):
+                    threading.Thread(
+                        target=self.__finish_lost, daemon=True, args=(ticket, epoch)
+                    ).start()
+                elif epoch < 0:
+                    # Terminal elements the worker did not put
+                    threading.Thread(
+                        target=self.epoch_gate.resume,
+                        daemon=True,
+                        args=(self.__put_lost_terminal,),
+                    ).start()
+                self.__start_worker()
+                n_new += 1
+        return n_new
+
+    def __report_lost(self, process, ticket: int) -> bool:
+        """Handle the element of a worker that exited while working on it
+        by `on_error`, the element itself is lost with the worker.
+        Returns False if the `Sequence` has to stop."""
+        error = f"""\
+Worker {process.name} (pid {process.pid}) of {self.name} exited with code \
+{process.exitcode} while working on input {ticket} of the step."""
+        if self.on_error == "raise":
+            self.error_queue.put((f"\n{error}", None, error, ""))
+            return False
+        self.metrics.add(errors=1)
+        if self.on_error == "deadletter":
+            self.error_queue.put(DeadLetter(self.name, None, error, ""))
+        return True
+
+    def __start_worker(self):
+        """Start a worker while the step runs, see `ForkServer`."""
+        if self.fork_server is None:
+            process = self._new_process()
+            process.start()
+        else:
+            process = self.fork_server.start_worker(self)
+        self.processes.append(process)
+
+    def __finish_lost(self, ticket: int, epoch: int):
+        """Finish the element lost with its worker without output."""
+        if ticket >= 0:
+            if not self.turnstile.pass_turn(ticket, self.shutdown_event):
+                return
+        self.epoch_gate.finish(epoch, self.__put_lost_terminal)
+
+    def __put_lost_terminal(self, terminal: TerminateQueue):
+        self.__wait_written(range(self.max_workers))
+        put_flushed(self.outq, terminal)
 
+    def __find_slot(self, pid: int):
+        for slot, slot_pid in enumerate(self.slot_pids):
+            if slot_pid == pid:
+                return slot
+        return None
+
+    def _worker_id(self) -> int:
+        """Id of the calling worker in `slot_pids`."""
+        return os.getpid()
+
+    def __claim_slot(self) -> int:
+        with self.scale_cond:
+            slot = self.__find_slot(self.FREE_SLOT)
+            assert slot is not None
+            self.slot_pids[slot] = self._worker_id()
+            self.slot_tickets[slot] = -1
+        return slot
+
+    def inputs_complete(self, n_outputs: int) -> int:
+        if not (self.ordered or self.max_workers == 1):
+            raise RuntimeError(
+                f"{self.name} needs ordered=True to track the position of the inputs."
+            )
+        if self.on_error != "raise":
+            raise RuntimeError(
+                f"{self.name} drops elements, the position of the inputs is unknown."
+            )
+        return n_outputs
+
+    def __retire(self, slot: int) -> bool:
+        with self.scale_cond:
+            if self.n_active.value <= self.n_target.value:
+                return False
+            self.n_active.value -= 1
+        # The counters of the slot are taken over by the next worker
+        self.__wait_written([slot])
+        with self.scale_cond:
+            self.slot_pids[slot] = self.FREE_SLOT
+        logger.debug(f"{self.workername} retiring.")
+        return True
+
+    def _count_writes(self, slot: int) -> bool:
+        """Count the outputs that the feeder thread of this worker writes to
+        the output queue in `slot_writes`. Returns False if the output queue
+        has no feeder thread."""
+        if getattr(self.outq, "synchronous_put", False) or not hasattr(
+            self.outq, "_send_bytes"
+        ):
+            return False
+        # Only used by the feeder thread, see `ordering.write_flushed`
+        send_bytes = self.outq._send_bytes
+
+        def send_counted(payload):
+            send_bytes(payload)
+            self.slot_writes[slot] += 1
+
+        self.outq._send_bytes = send_counted
+        return True
+
+    def __wait_written(self, slots):
+        """Block until the feeder threads of the workers in `slots` wrote
+        the outputs put into them."""
+        while not self.shutdown_event.is_set():
+            if all(self.slot_puts[slot] == self.slot_writes[slot] for slot in slots):
+                return
+            time.sleep(0.001)
+
+    def __dequeue(self, slot: int):
+        """Take the next element from the input queue, draw its ticket and
+        count it for its epoch. Both are recorded for the slot before the
+        lock is released, so a crash of the worker can not lose them.
+        Returns the element, its epoch and its ticket."""
+        with self.dequeue_lock:
+            wkin = self.safe_get(self.inq)
+            ticket = None
+            if self.ordered and not isinstance(wkin, TerminateQueue):
+                ticket = self.slot_tickets[slot] = self.turnstile.draw()
+            epoch, terminals = self.epoch_gate.take(wkin, self.shutdown_event, slot)
+        self.epoch_gate.put_terminals(terminals, self.__put_terminal, slot)
+        return wkin, epoch, ticket
+
+    def __put_terminal(self, terminal: TerminateQueue):
+        # The outputs of the epoch may still be in the feeder threads
+        self.__wait_written(range(self.max_workers))
+        self.safe_put(self.outq, terminal, flush=True)
         logger.debug(
             f"""\
-{self.workername} finished with iterable (in {self.count_in}/out {self.count_out})"""
+{self.workername} put terminal element of epoch {terminal.epoch} in outq."""
         )
-        self.count_in, self.count_out = 0, 0
 
     def _worker(self, shutdown_event):
         self.set_workername()
+        slot = self.__claim_slot()
+        # Unordered outputs are written by the feeder thread
+        buffered = self._count_writes(slot) and self.on_error == "raise"
+        n_tasks = 0
 
         logger.debug(
             f"{self.workername} start reading from input queue {id(self.inq)}."
         )
         while not shutdown_event.is_set():
+            if self.n_active.value > self.n_target.value and self.__retire(slot):
+                break
+            # Exit holding the slot, so the worker is replaced
+            if self.max_tasks is not None and n_tasks >= self.max_tasks:
+                logger.debug(f"{self.workername} exiting after {n_tasks} elements.")
+                break
             try:
                 try:
-                    wkin = self.inq.get(block=True, timeout=0.05)
+                    wkin, epoch, ticket = self.__dequeue(slot)
                 except Empty:
                     continue
                 logger.debug(
                     f"""\
     {self.workername} working on element of type {type(wkin)} from queue {id(self.inq)}."""
                 )
-                # If the process gets the terminate_queue object,
-                # wait for the others and put it in the next queue
+                # The terminal element is put by the `EpochGate` once
+                # all elements of its epoch are finished
                 if isinstance(wkin, TerminateQueue):
-                    self.__handle_terminal()
+                    logger.debug(
+                        f"{self.workername} took terminal element of epoch {wkin.epoch}."
+                    )
                     continue
                 self.count_in += 1
+                n_tasks += 1
 
                 # We need to overwrite the method of cloning the batches
                 # because we have list of tensors as attibutes of the batch.
                 # If copy.deepcopy is called on this object
 
-                wkin = self._clone_tensors(wkin)
+                wkin = self._take_ownership(wkin)
 
-                try:
-                    wkout = self.workerfn(wkin)
+                key, hit, wkout = self._cache_lookup(wkin)
+                dropped = False
+                if not hit:
+                    start = time.perf_counter()
+                    try:
+                        wkout = self._call(wkin)
 
-                # Catch Errors in the worker function
-                except Exception as error:
-                    self.handle_error(error, wkin)
-                    break
+                    # Catch Errors in the worker function
+                    except Exception as error:
+                        if not self._drop(error, wkin):
+                            break
+                        dropped = True
+                    if not dropped:
+                        self.metrics.add(work_time=time.perf_counter() - start)
+                        self._trace("work", start)
+                        self._cache_store(key, wkout)
 
                 logger.debug(
                     f"{self.workername} push single "
                     + f"output of type {type(wkout)} into output queue {id(self.outq)}."
                 )
-                self.safe_put(self.outq, wkout)
-                self.count_out += 1
+                # Outputs of the next epoch wait for the terminal element
+                if not self.epoch_gate.wait_epoch(epoch, shutdown_event):
+                    break
+                if self.ordered:
+                    if not self.turnstile.wait_turn(ticket, shutdown_event):
+                        break
+                    if not dropped:
+                        self.safe_put(self.outq, wkout, flush=True)
+                    self.turnstile.next_turn()
+                elif not dropped:
+                    self.safe_put(self.outq, wkout, flush=not buffered)
+                    if buffered:
+                        self.slot_puts[slot] += 1
+                if not dropped:
+                    self.count_out += 1
+                # Clears the slot, the element is not finished again by `respawn`
+                self.epoch_gate.finish(epoch, self.__put_terminal, slot)
                 del wkin
             except KeyboardInterrupt:
                 break
@@ -0,0 +1,49 @@
+from torch import multiprocessing as mp
+
+
+class ProgressLog:
+    """Shared log of a step that regroups the elements (eg. `PackStep`),
+    which records for each output how many of the inputs of the step were
+    completely contained in the outputs up to this one. Counted over all
+    iterables, so epochs queued ahead do not overwrite the entries.
+    Only the last `size` outputs are kept."""
+
+    def __init__(self, size: int = 2**16):
+        self.size = size
+        self._n_outputs = mp.Array("q", size, lock=False)
+        self._n_inputs = mp.Array("q", size, lock=False)
+        # Totals of the worker process
+        self.n_outputs = 0
+        self.n_inputs = 0
+
+    def record_output(self, n_inputs_complete: int):
+        """Called before an output is put."""
+        self.n_outputs += 1
+        slot = self.n_outputs % self.size
+        self._n_inputs[slot] = n_inputs_complete
+        self._n_outputs[slot] = self.n_outputs
+
+    def inputs_complete(self, n_outputs: int) -> int:
+        if n_outputs == 0:
+            return 0
+        slot = n_outputs % self.size
+        if self._n_outputs[slot] != n_outputs:
+            raise RuntimeError(
+                f"Output {n_outputs} is not in the progress log anymore,"
+                " increase the size of the log."
+            )
+        return self._n_inputs[slot]
+
+
+def with_last(iterable):
+    """Yields the elements of the iterable together with a flag
+    that marks the last element."""
+    iterator = iter(iterable)
+    try:
+        element = next(iterator)
+    except StopIteration:
+        return
+    for following in iterator:
+        yield element, False
+        element = following
+    yield element, True
@@ -0,0 +1,227 @@
+"""Run the worker function of a step on other hosts.
+
+The `RemoteStep` listens on a TCP address, remote workers started with
+
+    QUEUEFLOW_AUTHKEY=secret python -m queueflow.remote_worker HOST:PORT --nworkers 8
+
+connect to it and process the elements (see `queueflow.remote_worker`).
+The worker function is sent to the workers pickled by reference, so its
+module must be importable on the remote hosts.
+"""
+import os
+import pickle
+import queue
+import threading
+import time
+from collections import deque
+from multiprocessing.connection import Listener, wait
+from multiprocessing.queues import Empty
+
+from torch import multiprocessing as mp
+
+from . import pickling
+from .logger import logger
+from .step_base import StepBase
+from .terminate_queue import TerminateQueue
+
+
+def send_element(conn, obj):
+    """Send `obj` over the connection: a small header with the pickle stream
+    and the sizes of the buffers, followed by the raw buffers."""
+    stream, raws = pickling.dumps(obj)
+    conn.send_bytes(pickle.dumps(([raw.nbytes for raw in raws], stream)))
+    for raw in raws:
+        conn.send_bytes(raw)
+
+
+def recv_element(conn):
+    sizes, stream = pickle.loads(conn.recv_bytes())
+    buffers = []
+    for size in sizes:
+        buffer = bytearray(size)
+        if size:
+            conn.recv_bytes_into(buffer)
+        else:
+            conn.recv_bytes()
+        buffers.append(buffer)
+    return pickling.loads(stream, buffers)
+
+
+class RemoteStep(StepBase):
+    """Step whose worker function runs in remote worker processes, which
+    connect over TCP to `address` (see the `queueflow.remote` module).
+    The step itself runs one local process, that sends the elements
+    to the connected workers and puts their outputs in the output queue.
+
+    Each worker gets at most `credits` elements before it has returned
+    an output, which bounds the number of elements in flight like the
+    size of a queue. Elements in flight on a worker that disconnects are
+    sent to the other workers. With `pool_size` each remote worker maps
+    the function over the elements of the incoming iterables with a pool
+    of that many processes, like a `PoolStep`.
+
+    The outputs are put in the order they arrive, a `Sequence` or
+    `Parallel` that requires ordered outputs raises a ValueError.
+    `authkey` authenticates
+    the workers, only share it with trusted hosts: the connections
+    transport pickled objects."""
+
+    def __init__(
+        self,
+        *args,
+        address=("0.0.0.0", 0),
+        authkey: bytes = None,
+        credits: int = 2,
+        pool_size: int = None,
+        **kwargs,
+    ):
+        kwargs["nworkers"] = 1
+        kwargs.setdefault("name", "Remote")
+        super().__init__(*args, **kwargs)
+        if self.cache is not None:
+            raise ValueError("RemoteStep does not support a cache.")
+        if self.retries:
+            raise ValueError("RemoteStep does not support retries.")
+        if authkey is None:
+            authkey = os.environ.get("QUEUEFLOW_AUTHKEY", "").encode()
+        if not authkey:
+            raise ValueError("RemoteStep needs an authkey (or QUEUEFLOW_AUTHKEY).")
+        assert credits >= 1
+        self.credits = credits
+        self.pool_size = pool_size
+        self.authkey = authkey
+        # Listen already, so the port is known before the step is started
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.n_connected = mp.Value("i", 0)
+        logger.info(f"{self.name} listening for remote workers on {self.address}")
+
+    @property
+    def ordered(self) -> bool:
+        return False
+
+    @ordered.setter
+    def ordered(self, ordered: bool):
+        # Several elements are in flight on the remote workers
+        if ordered:
+            raise ValueError(f"{self.name} puts the outputs in the order they arrive.")
+
+    def process_status(self):
+        alive = all(p.is_alive() for p in self.processes)
+        return (self.n_connected.value * alive, self.n_connected.value)
+
+    def __accept(self, new_connections, wakeup, shutdown_event):
+        while not shutdown_event.is_set():
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                break
+            except Exception as error:
+                logger.warning(f"{self.workername} rejected a connection: {error}")
+                continue
+            conn.send((self.workerfn, self.pool_size))
+            new_connections.put(conn)
+            wakeup.send_bytes(b"1")
+
+    def _worker(self, shutdown_event):
+        self.set_workername()
+        new_connections = queue.Queue()
+        wakeup_reader, wakeup = mp.Pipe(duplex=False)
+        threading.Thread(
+            target=self.__accept,
+            daemon=True,
+            args=(new_connections, wakeup, shutdown_event),
+        ).start()
+        # Elements sent to each worker and not returned yet, oldest first
+        inflight = {}
+        # Elements of disconnected workers, sent again first
+        retry = deque()
+        terminal = None
+
+        while not shutdown_event.is_set():
+            while not new_connections.empty():
+                inflight[new_connections.get()] = deque()
+                self.n_connected.value = len(inflight)
+                logger.info(f"{self.workername} remote worker connected.")
+            free = [c for c, sent in inflight.items() if len(sent) < self.credits]
+            can_read = free and not retry and terminal is None
+            if free and retry:
+                self.__send(free[0], retry.popleft(), inflight, retry)
+                continue
+            waitlist = [*inflight, wakeup_reader, shutdown_event.reader]
+            if can_read:
+                waitlist.append(self.inq._reader)
+            ready = wait(waitlist)
+            if wakeup_reader in ready:
+                wakeup_reader.recv_bytes()
+            for conn in [c for c in ready if c in inflight]:
+                if not self.__receive(conn, inflight, retry):
+                    return self.__finish(inflight)
+            if can_read and self.inq._reader in ready:
+                try:
+                    wkin = self.inq.get(block=True, timeout=0.05)
+                except Empty:
+                    continue
+                if isinstance(wkin, TerminateQueue):
+                    terminal = wkin
+                else:
+                    self.metrics.add(items_in=1)
+                    self.count_in += 1
+                    # Workers might have disconnected in the meantime
+                    free = [c for c in free if c in inflight]
+                    if not free:
+                        retry.append(wkin)
+                        continue
+                    conn = min(free, key=lambda c: len(inflight[c]))
+                    self.__send(conn, wkin, inflight, retry)
+            if terminal is not None and not retry and not any(inflight.values()):
+                self.safe_put(self.outq, terminal)
+                logger.debug(
+                    f"""\
+{self.workername} finished with iterable (in {self.count_in}/out {self.count_out})"""
+                )
+                self.count_in, self.count_out, terminal = 0, 0, None
+        self.__finish(inflight)
+
+    def __send(self, conn, wkin, inflight, retry):
+        try:
+            send_element(conn, wkin)
+            inflight[conn].append((wkin, time.perf_counter()))
+        except OSError:
+            retry.appendleft(wkin)
+            self.__disconnect(conn, inflight, retry)
+
+    def __receive(self, conn, inflight, retry) -> bool:
+        """Put the output of a worker, returns False if the worker failed."""
+        try:
+            status, wkout = recv_element(conn)
+        except (EOFError, OSError):
+            self.__disconnect(conn, inflight, retry)
+            return True
+        except Exception as error:
+            self.handle_error(error, inflight[conn][0][0])
+            return False
+        wkin, start = inflight[conn].popleft()
+        if status == "error":
+            error, tb = wkout
+            return self._drop(error, wkin, tb)
+        self.metrics.add(work_time=time.perf_counter() - start)
+        self._trace("remote work", start)
+        self.safe_put(self.outq, wkout)
+        self.count_out += 1
+        return True
+
+    def __disconnect(self, conn, inflight, retry):
+        logger.warning(
+            f"""\
+{self.workername} lost a remote worker, resending {len(inflight[conn])} elements."""
+        )
+        retry.extend(wkin for wkin, _ in inflight.pop(conn))
+        self.n_connected.value = len(inflight)
+        conn.close()
+
+    def __finish(self, inflight):
+        self.listener.close()
+        for conn in inflight:
+            conn.close()
+        self._close_queues()
@@ -0,0 +1,70 @@
+"""Remote workers for a `RemoteStep`, started on the other hosts with
+
+    QUEUEFLOW_AUTHKEY=secret python -m queueflow.remote_worker HOST:PORT --nworkers 8
+
+Kept apart from `queueflow.remote`, which is imported by the package.
+"""
+import argparse
+import os
+import traceback
+from multiprocessing.connection import Client
+
+from torch import multiprocessing as mp
+
+from .logger import logger
+from .remote import recv_element, send_element
+
+
+def run_worker(address, authkey: bytes):
+    """Connect to a `RemoteStep` and process elements until it disconnects."""
+    conn = Client(address, authkey=authkey)
+    workerfn, pool_size = conn.recv()
+    pool = mp.Pool(pool_size) if pool_size else None
+    logger.info(f"Remote worker {os.getpid()} connected to {address}")
+    while True:
+        try:
+            wkin = recv_element(conn)
+        except (EOFError, OSError):
+            break
+        try:
+            wkout = pool.map(workerfn, wkin) if pool else workerfn(wkin)
+            reply = ("ok", wkout)
+        except Exception as error:
+            reply = ("error", (str(error), traceback.format_exc()))
+        try:
+            send_element(conn, reply)
+        except (EOFError, OSError):
+            break
+    if pool is not None:
+        pool.close()
+        pool.join()
+    logger.info(f"Remote worker {os.getpid()} disconnected")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Start workers for a queueflow RemoteStep."
+    )
+    parser.add_argument("address", help="HOST:PORT of the RemoteStep")
+    parser.add_argument("--nworkers", type=int, default=1)
+    args = parser.parse_args()
+    host, port = args.address.rsplit(":", 1)
+    authkey = os.environ.get("QUEUEFLOW_AUTHKEY", "").encode()
+    if not authkey:
+        parser.error("Set the authkey of the RemoteStep in QUEUEFLOW_AUTHKEY.")
+    workers = [
+        mp.Process(target=run_worker, args=((host, int(port)), authkey))
+        for _ in range(args.nworkers)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    # Run the functions of the imported module, so the objects
+    # pickled by the workers do not refer to `__main__`.
+    from queueflow.remote_worker import main
+
+    main()
@@ -0,0 +1,76 @@
+import random
+
+import torch
+
+from .handlers import clone
+
+REPLAY_SHUFFLE = (None, "batch", "element")
+
+
+def shared_copy(element):
+    """Copy of the element with the tensors in shared memory: the consumer
+    may change the returned outputs in place, and the stored outputs can be
+    passed on to other processes without copying them."""
+    if isinstance(element, (list, tuple)):
+        values = [shared_copy(v) for v in element]
+        if hasattr(element, "_fields"):
+            return type(element)(*values)
+        return type(element)(values)
+    if isinstance(element, dict):
+        return {k: shared_copy(v) for k, v in element.items()}
+    if isinstance(element, torch.Tensor) and not element.is_cuda:
+        # Copied once, directly into shared memory
+        return torch.empty_like(element).share_memory_().copy_(element)
+    element = clone(element)
+    if hasattr(element, "share_memory_") and not getattr(element, "is_cuda", False):
+        element.share_memory_()
+    return element
+
+
+class ReplayBuffer:
+    """Outputs of a recorded epoch of a `Sequence`, kept in shared memory
+    to serve later epochs without running the steps again. The outputs
+    are copied when they are recorded, the replayed outputs have to be
+    copied by the caller."""
+
+    def __init__(self):
+        self.epoch = None
+        self.outputs = []
+
+    def start(self, epoch: int):
+        """Drop the previous recording and record the outputs of `epoch`."""
+        self.epoch = epoch
+        self.outputs = []
+
+    def record(self, output):
+        self.outputs.append(shared_copy(output))
+
+    def replay(self, shuffle: str = None, seed: int = None):
+        """Iterate the recorded outputs. `shuffle="batch"` shuffles the order
+        of the outputs, `shuffle="element"` shuffles the elements of outputs
+        that are lists or tuples across the outputs, keeping their lengths."""
+        if shuffle not in REPLAY_SHUFFLE:
+            raise ValueError(f"shuffle must be one of {REPLAY_SHUFFLE}")
+        rng = random.Random(seed)
+        if shuffle is None:
+            yield from self.outputs
+        elif shuffle == "batch":
+            order = list(range(len(self.outputs)))
+            rng.shuffle(order)
+            for i in order:
+                yield self.outputs[i]
+        else:
+            if not all(type(o) in (list, tuple) for o in self.outputs):
+                raise TypeError(
+                    "Shuffling the elements needs outputs that are lists or tuples,"
+                    " eg. a RepackStep without collate_fn."
+                )
+            elements = [e for output in self.outputs for e in output]
+            rng.shuffle(elements)
+            i = 0
+            for output in self.outputs:
+                yield type(output)(elements[i : i + len(output)])
+                i += len(output)
+
+    def __len__(self):
+        return len(self.outputs)
@@ -1,15 +1,37 @@
 import signal
 import threading
 import time
+from collections import deque
 from multiprocessing.queues import Empty
-from multiprocessing.queues import Queue as queues_class
 
 from prettytable import PrettyTable
 from torch import multiprocessing as mp
 
+from .autoscale import Autoscaler
+from .byte_queue import ByteQueue, ResizableQueue, _ReservingQueue
+from .errors import DeadLetter
+from .fork_server import ForkServer
 from .in_out import InputStep, OutputStep
 from .logger import logger
-from .step_base import StepBase
+from .metrics import MetricsServer
+from .ownership import OWNERSHIP_MODES
+from .replay import REPLAY_SHUFFLE, ReplayBuffer
+from .shutdown_event import get_or_shutdown
+from .process_step import ProcessStep
+from .step_base import StepBase, _all_steps
+from .thread_step import QUEUE_TYPES, ThreadQueue, ThreadStep
+from .trace import Tracer
+from .tuning import QueueTuner
+
+
+def _keeps_epochs(queue) -> bool:
+    """Whether the terminal element put into the queue stays behind the
+    elements other processes put before it, when the queue holds more than
+    one element: the elements are written before `put` returns or the
+    terminal element waits until the queue is empty."""
+    return isinstance(queue, _ReservingQueue) or getattr(
+        queue, "synchronous_put", False
+    )
 
 
 class Sequence:
@@ -28,42 +50,178 @@ class Sequence:
      but `batch.x.clone()` or `batch.x + 1` will lead to a crash.
      This problem may or may not go way by spawning the subprocesses instead of forking them,
      as recommended in the torch.multiprocessing package.
+
+    `queue_type` is called with the maximal size to create the queues
+    inserted between the steps, eg. `ShmQueue` to pass array payloads
+    through shared memory. Defaults to `torch.multiprocessing.Queue`.
+
+    With `memory_budget` (in bytes) the queues inserted between the steps
+    are `ByteQueue`s that share the budget equally, so each holds as many
+    elements as fit into its share. The queue after the input and queues
+    given in `seq` are not part of the budget.
+
+    `queue_depths` gives the sizes of the queues inserted between the
+    steps (except the queue after the input), instead of 1. Queues larger
+    than 1 are `ResizableQueue`s, because elements held back by the feeder
+    threads of the workers could be overtaken by the terminal element in
+    a `multiprocessing.Queue`. A `queue_type` needs to write the elements
+    synchronously for sizes larger than 1. With
+    `tune_queues` these queues are `ResizableQueue`s that a `QueueTuner`
+    resizes to the jitter of the steps observed during the first
+    `tune_warmup` seconds of data flow. It logs the chosen sizes, which
+    can then be pinned with `queue_depths`.
+
+    With `autoscale` the number of workers of the steps that have
+    `min_workers < max_workers` is adapted to the saturation of
+    their queues every `autoscale_interval` seconds.
+
+    With `ordered` all steps emit their outputs in the order of their
+    inputs, so the outputs of the sequence keep the order of the iterable.
+    Steps that can not keep the order raise a ValueError.
+
+    With `trace` the spans of the workers are recorded and written to
+    this file as a Chrome trace when the sequence is stopped, see
+    `start_trace`.
+
+    `ownership="move"` makes all steps use the received elements in place
+    instead of cloning them, see `StepBase`. With `check_ownership` the
+    steps raise an error if they modify an element after putting it.
+
+    The elements the steps with `on_error="deadletter"` failed on are
+    collected in `dead_letters`. Workers of the `ProcessStep`s that exit
+    unexpectedly are replaced every `respawn_interval` seconds. Workers
+    started while the sequence runs are forked by a `ForkServer`.
+
+    Further iterables can be queued before the current one has been
+    consumed, each iterable is an epoch that ends with a `StopIteration`.
+    The processes of the steps keep running between the epochs.
+    With `queue_iterable(iterable, record=True)` the outputs of the epoch
+    are stored, `queue_replay` queues epochs served from these outputs.
     """
 
     def __init__(
         self,
         shutdown_event: mp.Event,
         *seq,
+        queue_type: callable = None,
+        autoscale: bool = False,
+        autoscale_interval: float = 1.0,
+        ordered: bool = False,
+        ownership: str = None,
+        check_ownership: bool = False,
+        trace: str = None,
+        memory_budget: int = None,
+        queue_depths: list = None,
+        tune_queues: bool = False,
+        tune_warmup: float = 10.0,
+        respawn_interval: float = 1.0,
     ):
-        self.__iterable_queued = False
+        # Ids of the queued epochs that have not been consumed yet
+        self.__queued_epochs = deque()
+        self.__next_epoch = 0
+        # Recorded epochs and the shuffling of the replayed epochs
+        self.__record_epochs = set()
+        self.__replay_epochs = {}
+        self.__replay_iter = None
+        self.replay_buffer = ReplayBuffer()
         self.__seq = [InputStep(), *seq, OutputStep()]
 
         self.shutdown_event: mp.Event = shutdown_event
+        if queue_type is not None and memory_budget is not None:
+            raise ValueError("Give either queue_type or memory_budget.")
+        if tune_queues and (queue_type is not None or memory_budget is not None):
+            raise ValueError(
+                "tune_queues can not be combined with queue_type or memory_budget."
+            )
+        if memory_budget is not None and queue_depths is not None:
+            raise ValueError("Give either queue_depths or memory_budget.")
+        self.queue_type = mp.Queue if queue_type is None else queue_type
         self.error_queue: mp.Queue = mp.Queue()
+        self.dead_letters: list = []
+        self.respawn_interval = respawn_interval
         # Chain the processes and queues
 
         for elem in self.__seq:
-            assert isinstance(elem, (queues_class, StepBase, InputStep, OutputStep))
+            assert isinstance(elem, (*QUEUE_TYPES, StepBase, InputStep, OutputStep))
         # Insert the queues in between the steps
         i = 0
         while i < len(self.__seq):
             if isinstance(self.__seq[i], (StepBase, InputStep)):
-                if not isinstance(self.__seq[i + 1], queues_class):
+                if not isinstance(self.__seq[i + 1], QUEUE_TYPES):
+                    in_process = (InputStep, OutputStep, ThreadStep)
+                    # Steps in this process hand over the elements directly
+                    if isinstance(self.__seq[i], in_process) and isinstance(
+                        self.__seq[i + 1], in_process
+                    ):
+                        new_queue = ThreadQueue(
+                            0 if isinstance(self.__seq[i], InputStep) else 1
+                        )
                     # Allow the InputQueue to be infinitly big
-                    if isinstance(self.__seq[i], InputStep):
+                    elif isinstance(self.__seq[i], InputStep):
                         new_queue = mp.Queue()
-                    # Standard for all other steps
+                    # Standard for all other steps,
+                    # created below once the number of queues is known
                     else:
-                        new_queue = mp.Queue(1)
+                        new_queue = None
                     self.__seq.insert(i + 1, new_queue)
             i += 1
+        inserted = [i for i, elem in enumerate(self.__seq) if elem is None]
+        if queue_depths is None:
+            queue_depths = [1] * len(inserted)
+        if len(queue_depths) != len(inserted):
+            raise ValueError(
+                f"queue_depths needs {len(inserted)} sizes, one per inserted queue."
+            )
+        for i, depth in zip(inserted, queue_depths):
+            if memory_budget is not None:
+                self.__seq[i] = ByteQueue(memory_budget // len(inserted))
+            elif tune_queues or (depth > 1 and queue_type is None):
+                self.__seq[i] = ResizableQueue(depth)
+            else:
+                self.__seq[i] = self.queue_type(depth)
+                if depth > 1 and not _keeps_epochs(self.__seq[i]):
+                    raise ValueError(
+                        f"""\
+{type(self.__seq[i]).__name__} can not hold more than one element between the \
+steps, the terminal element could overtake the elements put before it."""
+                    )
+        self.inserted_queues = [self.__seq[i] for i in inserted]
         for i, elem in enumerate(self.__seq):
             if i % 2 == 0:
                 continue
-            assert isinstance(elem, queues_class)
+            assert isinstance(elem, QUEUE_TYPES)
 
-        self.queues = [q for q in self.__seq if isinstance(q, queues_class)]
+        self.queues = [q for q in self.__seq if isinstance(q, QUEUE_TYPES)]
         self.steps = [p for p in self.__seq if isinstance(p, StepBase)]
+        # Steps with a single worker (pack steps, pools) keep the order anyway
+        if ordered:
+            for step in self.steps:
+                if hasattr(step, "ordered"):
+                    step.ordered = True
+        if ownership is not None:
+            if ownership not in OWNERSHIP_MODES:
+                raise ValueError(f"ownership must be one of {OWNERSHIP_MODES}")
+            for step in [*self.steps, self.__seq[-1]]:
+                step.ownership = ownership
+        if check_ownership:
+            for step in self.steps:
+                step.check_ownership = True
+        # Workers started while the sequence runs are forked by the
+        # fork server, as the sequence forks before it starts its threads
+        forked = [
+            step
+            for step in _all_steps(self.steps)
+            if isinstance(step, ProcessStep) and not isinstance(step, ThreadStep)
+        ]
+        self.fork_server = ForkServer(forked) if forked else None
+        for step in forked:
+            step.fork_server = self.fork_server
+        self.tracer = Tracer()
+        self.trace_path = None
+        for step in self.steps:
+            step.tracer = self.tracer
+        if trace is not None:
+            self.start_trace(trace)
         # Connect the input:
         self.__seq[0].connect_to_sequence(
             output_queue=self.__seq[1],
@@ -83,7 +241,7 @@ class Sequence:
 
         # make sure everything is connected properly
         for i in range(len(self.__seq) - 1):
-            if isinstance(self.__seq[i], queues_class):
+            if isinstance(self.__seq[i], QUEUE_TYPES):
                 continue
             assert self.__seq[i].outq is self.__seq[i + 2].inq
             assert self.__seq[i].outq is self.__seq[i + 1]
@@ -96,15 +254,28 @@ class Sequence:
         self.error_queue_thread = threading.Thread(
             target=self.read_error_queue, daemon=True, args=(self.shutdown_event,)
         )
+        self.respawn_thread = threading.Thread(
+            target=self.respawn_workers, daemon=True, args=(self.shutdown_event,)
+        )
+        self.metrics_server = None
+        self.autoscaler = (
+            Autoscaler(self, interval=autoscale_interval) if autoscale else None
+        )
+        self.queue_tuner = (
+            QueueTuner(self, warmup=tune_warmup) if tune_queues else None
+        )
         self.started = False
 
     def start(self):
         assert not self.started
         logger.debug("Before Sequence Start\n" + str(self.flowstatus()))
 
-        for seq_elem in self.__seq:
-            if isinstance(seq_elem, StepBase):
-                seq_elem.start()
+        # Start the threads last, forking a process with
+        # running threads can deadlock the new process.
+        if self.fork_server is not None:
+            self.fork_server.start()
+        for seq_elem in sorted(self.steps, key=lambda s: isinstance(s, ThreadStep)):
+            seq_elem.start()
         for step in self.__seq:
             logger.debug(
                 (
@@ -116,6 +287,11 @@ class Sequence:
 
         self.status_printer_thread.start()
         self.error_queue_thread.start()
+        self.respawn_thread.start()
+        if self.autoscaler is not None:
+            self.autoscaler.start()
+        if self.queue_tuner is not None:
+            self.queue_tuner.start()
         self.started = True
         self.__sigtermhandle = SigTermHandel(self)
 
@@ -123,33 +299,156 @@ class Sequence:
         return self
 
     def __next__(self):
-        if not self.__iterable_queued:
+        self.__check_iterable()
+        if self.__queued_epochs[0] in self.__replay_epochs:
+            return self.__next_replayed()
+        try:
+            out = next(self.__seq[-1])
+            return self.__record(out)
+        except StopIteration:
+            logger.debug("Sequence: Stop Iteration encountered.")
+            self.__end_epoch()
+            raise StopIteration
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Asynchronous iteration, eg. `async for batch in qfseq:`.
+        Waits for the outputs without blocking the event loop."""
+        self.__check_iterable()
+        if self.__queued_epochs[0] in self.__replay_epochs:
+            try:
+                return self.__next_replayed()
+            except StopIteration:
+                raise StopAsyncIteration
+        try:
+            out = await self.__seq[-1].__anext__()
+            return self.__record(out)
+        except StopAsyncIteration:
+            logger.debug("Sequence: Stop Iteration encountered.")
+            self.__end_epoch()
+            raise StopAsyncIteration
+
+    def __check_iterable(self):
+        if not self.__queued_epochs:
             raise BufferError(
                 "No iterable queued: call queueflow.queue_iterable(iterable)"
             )
         if not self.started:
             raise RuntimeError("Start the queueflow sequence first.")
+
+    def __record(self, out):
+        epoch = self.__queued_epochs[0]
+        if epoch in self.__record_epochs:
+            if self.replay_buffer.epoch != epoch:
+                self.replay_buffer.start(epoch)
+            self.replay_buffer.record(out)
+        return out
+
+    def __next_replayed(self):
+        epoch = self.__queued_epochs[0]
+        if self.__replay_iter is None:
+            shuffle, seed = self.__replay_epochs[epoch]
+            self.__replay_iter = self.replay_buffer.replay(shuffle, seed)
         try:
-            out = next(self.__seq[-1])
-            return out
+            # The stored outputs are copied in the "move" mode as well,
+            # changes of the consumer would show up in the later replays
+            return self.__seq[-1]._clone_tensors(next(self.__replay_iter))
         except StopIteration:
-            logger.debug("Sequence: Stop Iteration encountered.")
+            logger.debug(f"Sequence: end of replayed epoch {epoch}.")
+            self.__replay_iter = None
+            del self.__replay_epochs[self.__queued_epochs.popleft()]
+            raise
+
+    def __end_epoch(self):
+        if self.shutdown_event.is_set():
+            return
+        epoch = self.__queued_epochs.popleft()
+        self.__record_epochs.discard(epoch)
+        assert self.__seq[-1].epoch == epoch, (
+            f"Expected the end of epoch {epoch}"
+            f" but got the end of epoch {self.__seq[-1].epoch}."
+        )
 
-            self.__iterable_queued = False
-            raise StopIteration
+    def queue_iterable(self, iterable, start: int = 0, record: bool = False):
+        """Queue the elements of `iterable` as the next epoch.
+        Can be called again before the previous epochs are consumed.
+        The first `start` elements are skipped without processing them,
+        eg. `start=checkpoint["offset"]` to resume after a restart.
+        With `record` the outputs are stored in the `replay_buffer`,
+        replacing the outputs of the previously recorded epoch."""
+        epoch = self.__next_epoch
+        self.__next_epoch += 1
+        self.__queued_epochs.append(epoch)
+        if record:
+            self.__record_epochs.add(epoch)
+        self.__seq[0].queue_iterable(iterable, epoch=epoch, start=start)
 
-    def queue_iterable(self, iterable):
-        assert not self.__iterable_queued
-        self.__seq[0].queue_iterable(iterable)
-        self.__iterable_queued = True
+        return self
+
+    def queue_replay(self, shuffle: str = None, seed: int = None):
+        """Queue an epoch that returns the outputs of the last recorded
+        epoch from the `replay_buffer`, without running the steps.
+        `shuffle="batch"` shuffles the order of the outputs,
+        `shuffle="element"` the elements of list outputs across the outputs.
+        Can be queued before the recorded epoch has been consumed."""
+        if shuffle not in REPLAY_SHUFFLE:
+            raise ValueError(f"shuffle must be one of {REPLAY_SHUFFLE}")
+        if not self.__record_epochs and self.replay_buffer.epoch is None:
+            raise RuntimeError(
+                "No epoch recorded, use queue_iterable(..., record=True)."
+            )
+        epoch = self.__next_epoch
+        self.__next_epoch += 1
+        self.__queued_epochs.append(epoch)
+        self.__replay_epochs[epoch] = (shuffle, seed)
 
         return self
 
+    def checkpoint(self) -> dict:
+        """Position of the consumer in the queued iterables: `offset` elements
+        of the iterable of `epoch` have been processed and their outputs
+        have been returned completely, including outputs that combine
+        several elements (`PackStep`, `RepackStep`). Outputs of later
+        elements that share an output with these are returned again
+        when resuming from the checkpoint.
+
+        Requires steps that keep the order, eg. `Sequence(..., ordered=True)`."""
+        if self.__queued_epochs and self.__queued_epochs[0] in self.__replay_epochs:
+            raise RuntimeError("Replayed epochs cannot be checkpointed.")
+        n_inputs = self.__seq[-1].count_out
+        for step in reversed(self.steps):
+            n_inputs = step.inputs_complete(n_inputs)
+        if not self.__queued_epochs:
+            return {"epoch": self.__next_epoch, "offset": 0}
+        epoch = self.__queued_epochs[0]
+        n_before, start = self.__seq[0].epochs[epoch]
+        return {"epoch": epoch, "offset": start + max(n_inputs - n_before, 0)}
+
+    def start_trace(self, path: str):
+        """Record the spans of the workers (get, work, put, blocked on full,
+        the subtasks of the pools and the regrouping of the pack steps)
+        until `stop_trace` or `stop` write them to `path` as Chrome trace."""
+        self.trace_path = path
+        self.tracer.enable()
+
+    def stop_trace(self) -> str:
+        """Stop recording and write the trace, returns its path. Spans
+        of processes that did not write them yet might be missing."""
+        path, self.trace_path = self.trace_path, None
+        self.tracer.disable()
+        if path is not None:
+            self.tracer.merge(path)
+        return path
+
     def stop(self):
         logger.info("Before Sequence Stop\n" + str(self.flowstatus()))
         logger.warning("Setting shutdown event!")
 
         self.shutdown_event.set()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
 
         # # Drain the queues:
         for queue in self.queues:
@@ -164,6 +463,11 @@ class Sequence:
         for istep, step in enumerate(self.steps):
             logger.debug(f"Stopping sequence step {istep}")
             step.stop()
+        if self.fork_server is not None:
+            self.fork_server.stop()
+        # The workers wrote their spans when they exited
+        if self.trace_path is not None:
+            self.stop_trace()
 
         # self.queues[0].close()
         # self.queues[0].join_thread()
@@ -192,9 +496,15 @@ Process {ip} (of {len(step.processes)}) of step {istep} is still alive!"""
         threading.current_thread().setName("readErrorQueue")
         while not shutdown_event.is_set() and not self.error_queue._closed:
             try:
-                workermsg, wkin, error, tb = self.error_queue.get(
-                    block=True, timeout=0.5
-                )
+                report = get_or_shutdown(self.error_queue, shutdown_event)
+                if isinstance(report, DeadLetter):
+                    logger.warning(
+                        f"""\
+{report.step} failed on an element, collected it in dead_letters: {report.error}"""
+                    )
+                    self.dead_letters.append(report)
+                    continue
+                workermsg, wkin, error, tb = report
 
                 # If there is an error, stop eveything
                 logger.error("Error, setting shutdown event!")
@@ -211,6 +521,12 @@ Process {ip} (of {len(step.processes)}) of step {istep} is still alive!"""
             except Empty:
                 continue
 
+    def respawn_workers(self, shutdown_event):
+        threading.current_thread().setName("respawnWorkers")
+        while not shutdown_event.wait(self.respawn_interval):
+            for step in self.steps:
+                step.respawn()
+
     def queue_status(self):
         return [
             (q.qsize(), q._maxsize if q._maxsize != 2147483647 else "inf")
@@ -220,12 +536,51 @@ Process {ip} (of {len(step.processes)}) of step {istep} is still alive!"""
     def process_status(self):
         return [p.process_status() for p in self.steps]
 
+    def hops(self):
+        """(producer, queue, consumer) for each queue of the sequence."""
+        return [
+            (self.__seq[i - 1], self.__seq[i], self.__seq[i + 1])
+            for i in range(1, len(self.__seq), 2)
+        ]
+
     def process_names(self):
         return [
             ",".join([p.name.split("-")[1] for p in step.processes])
             for step in self.steps
         ]
 
+    def metrics(self):
+        """Snapshot of the counters of the steps (throughput, time spent in the
+        worker function and time blocked on the input and output queues)
+        and of the saturation of the queues."""
+        return {
+            "steps": [
+                {
+                    "name": str(step.name),
+                    "workers": step.process_status()[0],
+                    **step.metrics.snapshot(len(step.processes)),
+                }
+                for step in _all_steps(self.steps)
+            ],
+            "queues": [
+                {
+                    "size": size,
+                    "maxsize": maxsize,
+                    "bytes": getattr(queue, "nbytes", None),
+                    "max_bytes": getattr(queue, "max_bytes", None),
+                }
+                for queue, (size, maxsize) in zip(self.queues, self.queue_status())
+            ],
+        }
+
+    def serve_metrics(self, port: int = 9100, host: str = "127.0.0.1"):
+        """Serve the metrics under `http://host:port/metrics`
+        in the Prometheus text format and under `/metrics.json`."""
+        assert self.metrics_server is None
+        self.metrics_server = MetricsServer(self, host=host, port=port)
+        self.metrics_server.start()
+        return self
+
     def flowstatus(self):
         queues_status = self.queue_status()
         processes_status = self.process_status()
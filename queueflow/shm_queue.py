@@ -0,0 +1,144 @@
+import io
+import os
+import pickle
+import time
+from multiprocessing import shared_memory
+from multiprocessing.queues import Full
+from multiprocessing.queues import Queue as queues_class
+from multiprocessing.reduction import ForkingPickler
+
+from torch import multiprocessing as mp
+
+from .logger import logger
+
+
+class ShmQueue(queues_class):
+    """Queue that passes the array payload of the elements through
+    a fixed-size ring of shared-memory slots instead of the pipe.
+
+    Elements are pickled with protocol 5, so contiguous numpy arrays
+    (and all other objects supporting out-of-band buffers) are written
+    once into a free slot and only the small pickle stream is sent
+    through the pipe. Torch tensors still use the shared memory
+    reducers of `torch.multiprocessing`. Elements without out-of-band
+    buffers or with buffers larger than `slot_size` are sent inline.
+    The receiving side copies the buffers out of the slot, so the slot
+    is free again as soon as `get` returns.
+
+    Can be placed in a `Sequence` like a `Queue` or passed as
+    `queue_type` to replace the automatically inserted queues.
+    """
+
+    # Elements are written to the pipe before `put` returns
+    synchronous_put = True
+
+    def __init__(
+        self, maxsize: int = 1, slot_size: int = 32 * 2**20, nslots: int = None
+    ):
+        super().__init__(maxsize, ctx=mp.get_context())
+        self.nslots = maxsize if nslots is None else nslots
+        if self.nslots < 1:
+            raise ValueError("ShmQueue needs at least one slot.")
+        self.slot_size = slot_size
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=self.nslots * self.slot_size
+        )
+        self._owner_pid = os.getpid()
+        self._free_slots = mp.Semaphore(self.nslots)
+        self._slot_used = mp.Array("b", self.nslots)
+
+    def __getstate__(self):
+        return (
+            super().__getstate__(),
+            self.nslots,
+            self.slot_size,
+            self._shm.name,
+            self._owner_pid,
+            self._free_slots,
+            self._slot_used,
+        )
+
+    def __setstate__(self, state):
+        (
+            base_state,
+            self.nslots,
+            self.slot_size,
+            shm_name,
+            self._owner_pid,
+            self._free_slots,
+            self._slot_used,
+        ) = state
+        super().__setstate__(base_state)
+        self._shm = shared_memory.SharedMemory(name=shm_name)
+
+    def put(self, obj, block=True, timeout=None):
+        # The element is written synchronously instead of by a feeder
+        # thread: the slot has to be filled before the message is sent.
+        if self._closed:
+            raise ValueError(f"Queue {self!r} is closed")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._sem.acquire(block, timeout):
+            raise Full
+        try:
+            message = ForkingPickler.dumps(self._encode(obj, block, deadline))
+            with self._wlock:
+                self._send_bytes(message)
+        except BaseException:
+            self._sem.release()
+            raise
+
+    def get(self, block=True, timeout=None):
+        slot, header, buffers = super().get(block, timeout)
+        if slot is not None:
+            buffers = self._read_slot(slot, buffers)
+        return pickle.loads(header, buffers=buffers)
+
+    def close(self):
+        super().close()
+        if self._shm is None:
+            return
+        self._shm.close()
+        if os.getpid() == self._owner_pid:
+            self._shm.unlink()
+            logger.debug(f"Shared memory {self._shm.name} unlinked")
+        self._shm = None
+
+    def _encode(self, obj, block, deadline):
+        buffers = []
+        stream = io.BytesIO()
+        ForkingPickler(stream, 5, True, buffers.append).dump(obj)
+        header = stream.getvalue()
+        raws = [buffer.raw() for buffer in buffers]
+        sizes = [raw.nbytes for raw in raws]
+        if not raws or sum(sizes) > self.slot_size:
+            return (None, header, [bytes(raw) for raw in raws])
+
+        slot = self._acquire_slot(block, deadline)
+        offset = slot * self.slot_size
+        for raw in raws:
+            self._shm.buf[offset : offset + raw.nbytes] = raw
+            offset += raw.nbytes
+        return (slot, header, sizes)
+
+    def _read_slot(self, slot, sizes):
+        offset = slot * self.slot_size
+        buffers = []
+        for size in sizes:
+            buffers.append(bytearray(self._shm.buf[offset : offset + size]))
+            offset += size
+        self._release_slot(slot)
+        return buffers
+
+    def _acquire_slot(self, block, deadline):
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        if not self._free_slots.acquire(block, timeout):
+            raise Full
+        with self._slot_used.get_lock():
+            slot = self._slot_used[:].index(0)
+            self._slot_used[slot] = 1
+        return slot
+
+    def _release_slot(self, slot):
+        with self._slot_used.get_lock():
+            self._slot_used[slot] = 0
+        self._free_slots.release()
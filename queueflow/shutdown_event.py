@@ -0,0 +1,85 @@
+import asyncio
+import time
+from multiprocessing.connection import wait
+from multiprocessing.queues import Empty
+
+from torch import multiprocessing as mp
+
+
+class ShutdownEvent:
+    """Event that can be waited for together with the queues.
+    When the event is set, a byte is written to a pipe that is never
+    read, so the reading end stays readable in all processes."""
+
+    def __init__(self):
+        self._event = mp.Event()
+        self.reader, self._writer = mp.Pipe(duplex=False)
+
+    def set(self):
+        if not self._event.is_set():
+            self._event.set()
+            self._writer.send_bytes(b"1")
+
+    def is_set(self) -> bool:
+        return self._event.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._event.wait(timeout)
+
+
+def get_or_shutdown(queue, shutdown_event, timeout: float = None):
+    """Get an element from the queue, blocking until an element is available.
+    Raises `Empty` as soon as the shutdown event is set or after `timeout`.
+
+    Queues backed by a pipe are waited for with `select` on the pipe of the
+    queue and the pipe of the shutdown event, so idle consumers do not poll.
+    Other queues are polled in short intervals."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    reader = getattr(queue, "_reader", None)
+    shutdown_reader = getattr(shutdown_event, "reader", None)
+    while not shutdown_event.is_set():
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            break
+        if reader is None or shutdown_reader is None:
+            poll_time = 0.05 if remaining is None else min(remaining, 0.05)
+            try:
+                return queue.get(block=True, timeout=poll_time)
+            except Empty:
+                continue
+        ready = wait([reader, shutdown_reader], remaining)
+        if reader not in ready:
+            continue
+        # Another consumer of the queue may have taken the element
+        # in the meantime, so only wait briefly.
+        try:
+            return queue.get(block=True, timeout=0.05)
+        except Empty:
+            continue
+    raise Empty
+
+
+async def wait_readable(queue, shutdown_event, timeout: float = None):
+    """Wait in the running event loop until the queue may hold an element,
+    the shutdown event is set or `timeout` passed. Queues that are not
+    backed by a pipe are polled in short intervals."""
+    reader = getattr(queue, "_reader", None)
+    shutdown_reader = getattr(shutdown_event, "reader", None)
+    if reader is None or shutdown_reader is None:
+        await asyncio.sleep(0.005 if timeout is None else min(timeout, 0.005))
+        return
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+
+    def set_ready():
+        if not ready.done():
+            ready.set_result(None)
+
+    fds = [reader.fileno(), shutdown_reader.fileno()]
+    for fd in fds:
+        loop.add_reader(fd, set_ready)
+    try:
+        await asyncio.wait([ready], timeout=timeout)
+    finally:
+        for fd in fds:
+            loop.remove_reader(fd)
@@ -1,18 +1,37 @@
 import threading
+import time
 import traceback
-from multiprocessing.queues import Full
+from multiprocessing.queues import Empty, Full
 
-import torch
-import torch_geometric
 from torch import multiprocessing as mp
 
-from .batch_utils import batch_to_numpy_dict
+from .cache import DiskCache
+from .errors import ERROR_POLICIES, DeadLetter, call_with_retries
 from .handle_data import HandleDataBase
+from .handlers import serialize
 from .logger import logger
+from .metrics import StepMetrics
+from .ownership import OWNERSHIP_MODES, OwnershipChecker
+from .ordering import put_flushed
+from .shutdown_event import get_or_shutdown
+from .terminate_queue import TerminateQueue
+
+
+def _all_steps(steps):
+    """The steps and the steps in the branches of `Parallel` steps."""
+    for step in steps:
+        yield step
+        yield from _all_steps(getattr(step, "branch_steps", []))
 
 
 class StepBase(HandleDataBase):
-    """Base class"""
+    """Base class
+
+    `on_error` decides what happens if the worker function raises for an
+    element, after it was called again up to `retries` times: "raise"
+    shuts down the `Sequence`, "skip" drops the element with a warning,
+    "deadletter" drops it and collects it in `Sequence.dead_letters`.
+    Dropped elements have no output."""
 
     def __init__(
         self,
@@ -21,23 +40,42 @@ class StepBase(HandleDataBase):
         nworkers: int = 1,
         deamonize: bool = True,
         name: str = "DefaultWorkerName",
+        ownership: str = "copy",
+        keeps_references: bool = False,
+        check_ownership: bool = False,
+        cache: DiskCache = None,
+        on_error: str = "raise",
+        retries: int = 0,
     ):
+        if ownership not in OWNERSHIP_MODES:
+            raise ValueError(f"ownership must be one of {OWNERSHIP_MODES}")
+        if on_error not in ERROR_POLICIES:
+            raise ValueError(f"on_error must be one of {ERROR_POLICIES}")
+        assert retries >= 0
         self.name = type(self) if name is None else name
+        # In the "move" mode the outputs are not cloned by the next step,
+        # steps that still hold references to their outputs have them cloned
+        # before the put. `check_ownership` detects modifications after a put.
+        self.ownership = ownership
+        self.keeps_references = keeps_references
+        self.check_ownership = check_ownership
+        self.ownership_checker = None
         self.workerfn = workerfn
+        # Outputs of the worker function stored by the hash of the input
+        self.cache = cache
+        self.cache_namespace = None if cache is None else cache.namespace(workerfn)
+        self.on_error = on_error
+        self.retries = retries
         self.nworkers = nworkers
         self.deamonize = deamonize
-        self.processes = [
-            mp.Process(
-                target=self._worker,
-                daemon=self.deamonize,
-                args=(shutdown_event,),
-            )
-            for _ in range(self.nworkers)
-        ]
+        self.shutdown_event = shutdown_event
+        self.processes = [self._new_process() for _ in range(self.nworkers)]
         self.count_in = 0
         self.count_out = 0
+        self.metrics = StepMetrics()
+        # Set by the `Sequence`, see `trace.Tracer`
+        self.tracer = None
         self.marked_as_working = False
-        self.shutdown_event = shutdown_event
 
     def connect_to_sequence(self, input_queue, output_queue, error_queue):
         self.inq = input_queue
@@ -45,6 +83,8 @@ class StepBase(HandleDataBase):
         self.error_queue = error_queue
 
     def _close_queues(self):
+        if self.tracer is not None:
+            self.tracer.flush()
         self.outq.close()
         self.outq.join_thread()
         logger.debug(f"""{self.workername} outq closed""")
@@ -60,7 +100,15 @@ class StepBase(HandleDataBase):
         mp.current_process().name = self.workername
         threading.current_thread().name = "MainThread-" + self.workername
 
+    def _new_process(self):
+        return mp.Process(
+            target=self._worker,
+            daemon=self.deamonize,
+            args=(self.shutdown_event,),
+        )
+
     def start(self):
+        self.metrics.reset_clock()
         for p in self.processes:
             p.start()
 
@@ -76,27 +124,155 @@ Had to kill process of name {self.name}."""
                     )
                 p.join(0)
 
-    def safe_put(self, queue, element):
-        # element = self._clone_tensors(element)
-        while not self.shutdown_event.is_set():
-            try:
-                queue.put(element, True, 1)
-                break
-            except Full:
-                continue
-            except KeyboardInterrupt:
-                break
+    def safe_put(self, queue, element, flush: bool = False):
+        """Put an element in the queue, retrying until there is space
+        or the shutdown event is set. With `flush` the element is written
+        to the queue synchronously (see `put_flushed`)."""
+        is_output = queue is self.outq and not isinstance(element, TerminateQueue)
+        if is_output and self.ownership == "move":
+            if self.keeps_references:
+                element = self._clone_tensors(element)
+            if self.check_ownership:
+                if self.ownership_checker is None:
+                    self.ownership_checker = OwnershipChecker()
+                self.ownership_checker.check(self.workername)
+                self.ownership_checker.record(element)
+        put = put_flushed if flush else type(queue).put
+        tracing = self.tracer is not None and self.tracer.enabled
+        start = time.perf_counter()
+        # Only the time the queue was full counts as blocked
+        blocked = False
+        try:
+            put(queue, element, False)
+        except Full:
+            blocked = True
+            while not self.shutdown_event.is_set():
+                try:
+                    put(queue, element, True, 1)
+                    break
+                except Full:
+                    continue
+                except KeyboardInterrupt:
+                    break
+        except KeyboardInterrupt:
+            pass
+        end = time.perf_counter()
+        self.metrics.add(
+            put_blocked_time=end - start if blocked else 0.0, items_out=int(is_output)
+        )
+        if tracing:
+            self._trace("put", start, end)
+            if blocked:
+                self._trace("blocked on full", start, end)
+
+    def safe_get(self, queue, timeout: float = None):
+        """Get an element from the queue, blocking until an element arrives.
+        Raises `Empty` when the shutdown event is set or after `timeout`."""
+        tracing = self.tracer is not None and self.tracer.enabled
+        if tracing and queue.empty():
+            # Write the spans before waiting, the process might stay idle
+            self.tracer.flush()
+        start = time.perf_counter()
+        # Only the time the queue was empty counts as blocked
+        blocked = True
+        try:
+            if not self.shutdown_event.is_set():
+                try:
+                    element = queue.get(block=False)
+                    blocked = False
+                except Empty:
+                    pass
+            if blocked:
+                element = get_or_shutdown(queue, self.shutdown_event, timeout)
+        finally:
+            end = time.perf_counter()
+            if blocked:
+                self.metrics.add(get_blocked_time=end - start)
+            if tracing:
+                self._trace("get", start, end)
+        if not isinstance(element, TerminateQueue):
+            self.metrics.add(items_in=1)
+        return element
+
+    def _trace(self, name: str, start: float, end: float = None, **args):
+        """Record a span from `start` (`time.perf_counter`) until `end` or now,
+        if the tracing of the `Sequence` is enabled."""
+        if self.tracer is not None and self.tracer.enabled:
+            end = time.perf_counter() if end is None else end
+            self.tracer.span(self.workername, name, start, end, args)
+
+    def _cache_lookup(self, wkin):
+        """Returns the cache key of the element, whether the output was
+        found in the cache and the output. The key is None without cache."""
+        if self.cache is None:
+            return None, False, None
+        key = self.cache.key(wkin, self.cache_namespace)
+        try:
+            wkout = self.cache[key]
+        except KeyError:
+            self.metrics.add(cache_misses=1)
+            return key, False, None
+        self.metrics.add(cache_hits=1)
+        return key, True, wkout
+
+    def _cache_store(self, key, wkout):
+        if key is not None:
+            self.cache.store(key, wkout)
 
     def process_status(self):
         return (sum([p.is_alive() for p in self.processes]), self.nworkers)
 
+    def scale(self, delta: int) -> bool:
+        """Add (`delta > 0`) or retire (`delta < 0`) workers within the bounds
+        `min_workers` and `max_workers`. Returns True if the number of workers
+        was changed. Steps that do not support scaling return False."""
+        return False
+
+    def respawn(self) -> int:
+        """Replace workers that exited unexpectedly, returns the number of
+        new workers. Steps that do not support it return 0."""
+        return 0
+
+    def inputs_complete(self, n_outputs: int) -> int:
+        """Number of inputs of the step that are completely contained in its
+        first `n_outputs` outputs, counted over all iterables. Used to
+        checkpoint the position of the `Sequence`."""
+        raise RuntimeError(f"{self.name} cannot track the position of the inputs.")
+
+    def _call(self, wkin):
+        """Call the worker function, calling it again up to `retries` times
+        if it raises."""
+        return call_with_retries(self.workerfn, self.retries, wkin)
+
+    def _drop(self, error, obj, tb: str = None) -> bool:
+        """Handle an element the worker function failed on by `on_error`.
+        Returns False if the worker has to stop. Call it in the `except`
+        block of the error or give the traceback `tb`."""
+        if self.on_error == "raise":
+            if tb is None:
+                self.handle_error(error, obj)
+            else:
+                workermsg = f"""
+{self.workername} failed on element of type {type(obj)}."""
+                self.error_queue.put((workermsg, serialize(obj), str(error), tb))
+            return False
+        self.metrics.add(errors=1)
+        if self.on_error == "deadletter":
+            tb = traceback.format_exc() if tb is None else tb
+            self.error_queue.put(
+                DeadLetter(self.workername, serialize(obj), str(error), tb)
+            )
+        else:
+            logger.warning(
+                f"""\
+{self.workername} skipped element of type {type(obj)} after error {error}"""
+            )
+        return True
+
     def handle_error(self, error, obj):
         tb = traceback.format_exc()
 
-        if isinstance(obj, torch.Tensor):
-            obj = obj.numpy()
-        if isinstance(obj, torch_geometric.data.Data):
-            obj = batch_to_numpy_dict(obj)
+        obj = serialize(obj)
 
         workermsg = f"""
 {self.workername} failed on element of type of type {type(obj)}."""
@@ -1,2 +1,6 @@
 class TerminateQueue:
-    pass
+    """Marks the end of an iterable. `epoch` counts the
+    iterables queued in the sequence."""
+
+    def __init__(self, epoch: int = None):
+        self.epoch = epoch
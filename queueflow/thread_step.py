@@ -0,0 +1,121 @@
+import itertools
+import queue
+import threading
+from multiprocessing.queues import Queue as queues_class
+
+from .logger import logger
+from .process_step import ProcessStep
+
+
+class ThreadQueue(queue.Queue):
+    """Queue between steps that run in the same process (`ThreadStep`s,
+    the input and the output of the `Sequence`). The elements are passed
+    on as references, without pickling.
+
+    Provides the parts of the `multiprocessing.Queue` interface
+    used by the `Sequence`."""
+
+    # Elements are available to the consumer when `put` returns
+    synchronous_put = True
+
+    def __init__(self, maxsize: int = 0):
+        super().__init__(maxsize)
+        self._maxsize = maxsize if maxsize > 0 else 2147483647
+        self._closed = False
+
+    def close(self):
+        self._closed = True
+
+    def join_thread(self):
+        pass
+
+    def cancel_join_thread(self):
+        pass
+
+
+# Queues that can connect steps
+QUEUE_TYPES = (queues_class, ThreadQueue)
+
+
+class _WorkerState(threading.local):
+    """Attributes that each worker thread of a `ThreadStep` keeps for
+    itself, the class attributes are the values in a new thread."""
+
+    workername = None
+    count_in = 0
+    count_out = 0
+    ownership_checker = None
+
+
+def _per_thread(attribute: str):
+    return property(
+        lambda self: getattr(self._state, attribute),
+        lambda self, value: setattr(self._state, attribute, value),
+    )
+
+
+class ThreadStep(ProcessStep):
+    """Like `ProcessStep`, but the workers are threads in the process that
+    starts the `Sequence`. Suited for I/O bound functions and functions
+    that release the GIL (eg. most numpy and torch kernels), as the
+    elements do not need to be pickled if the neighbouring steps run in
+    the same process: adjacent `ThreadStep`s and the input and output of
+    the `Sequence` are connected with `ThreadQueue`s.
+
+    The `Sequence` starts the thread steps after the process steps,
+    so no process is forked while the threads are running.
+    Workers added to the process steps later are forked by the `ForkServer`.
+
+    The name and the counters of a worker are kept per thread."""
+
+    _thread_counter = itertools.count(1)
+
+    workername = _per_thread("workername")
+    count_in = _per_thread("count_in")
+    count_out = _per_thread("count_out")
+    ownership_checker = _per_thread("ownership_checker")
+
+    def __init__(self, *args, **kwargs):
+        if kwargs.get("max_tasks") is not None:
+            raise ValueError("ThreadStep does not support max_tasks.")
+        self._state = _WorkerState()
+        super().__init__(*args, **kwargs)
+
+    def _new_process(self):
+        return threading.Thread(
+            target=self._worker,
+            daemon=True,
+            name=f"Thread-{next(self._thread_counter)}",
+            args=(self.shutdown_event,),
+        )
+
+    def set_workername(self):
+        self.workername = (
+            self.name + "-" + threading.current_thread().name.split("-")[1]
+        )
+
+    def _worker_id(self) -> int:
+        return threading.get_ident()
+
+    def _count_writes(self, slot: int) -> bool:
+        # The threads share the feeder thread of the output queue,
+        # so their outputs are written synchronously
+        return False
+
+    def respawn(self) -> int:
+        # Threads only exit after an error, the shutdown or a retirement
+        return 0
+
+    def stop(self):
+        for thread in self.processes:
+            thread.join(5)
+            if thread.is_alive():
+                logger.warning(
+                    f"""\
+Thread {thread.name} of {self.name} did not finish."""
+                )
+
+    def _close_queues(self):
+        # The queues are shared with the other threads of this
+        # process, they are closed by the `Sequence`.
+        pass
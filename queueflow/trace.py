@@ -0,0 +1,136 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from torch import multiprocessing as mp
+
+from .logger import logger
+
+# Tracer of the pool manager, inherited by the processes of its pool
+_pool_tracer = None
+
+
+class Tracer:
+    """Records spans of the workers of a `Sequence` in the Chrome trace
+    format (viewable with chrome://tracing or https://ui.perfetto.dev).
+
+    Each process buffers its spans and appends them to its own file in
+    a temporary directory before it blocks on an empty input queue,
+    once the buffer is full and when it exits. `merge` combines the
+    files into one trace. While the tracer is disabled, recording a
+    span costs a check of a shared flag."""
+
+    # Spans buffered before they are written
+    buffer_size = 1024
+    # Seconds after which the buffer of a busy process is written
+    flush_interval = 0.1
+
+    def __init__(self):
+        self._enabled = mp.Value("b", 0, lock=False)
+        self.directory = os.path.join(
+            tempfile.gettempdir(), f"queueflow-trace-{uuid.uuid4().hex}"
+        )
+        self._lock = threading.Lock()
+        self._pid = None
+        self._events = []
+        self._named = set()
+        self._last_flush = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._enabled.value)
+
+    def enable(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+        self._enabled.value = 1
+
+    def disable(self):
+        self._enabled.value = 0
+
+    def span(self, worker: str, name: str, start: float, end: float, args=None):
+        """Record a span between the `time.perf_counter` values `start` and
+        `end` on the timeline of the current thread, named after `worker`."""
+        if not self._enabled.value:
+            return
+        pid, tid = os.getpid(), threading.get_ident()
+        if self._pid != pid:
+            # Forked process: the spans and the lock of the parent
+            # process are not taken over
+            self._lock = threading.Lock()
+            self._pid, self._events, self._named = pid, [], set()
+        with self._lock:
+            if tid not in self._named:
+                self._named.add(tid)
+                self._events.append(
+                    {
+                        "ph": "M",
+                        "name": "thread_name",
+                        "pid": pid,
+                        "tid": tid,
+                        "args": {"name": worker},
+                    }
+                )
+            event = {
+                "ph": "X",
+                "name": name,
+                "cat": worker.rsplit("-", 1)[0],
+                "ts": start * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": pid,
+                "tid": tid,
+            }
+            if args:
+                event["args"] = args
+            self._events.append(event)
+            if (
+                len(self._events) >= self.buffer_size
+                or end - self._last_flush > self.flush_interval
+            ):
+                self.__flush()
+
+    def flush(self):
+        # Nothing was recorded by this process
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            self.__flush()
+
+    def __flush(self):
+        self._last_flush = time.perf_counter()
+        if not self._events:
+            return
+        events, self._events = self._events, []
+        try:
+            with open(os.path.join(self.directory, f"{self._pid}.jsonl"), "a") as f:
+                f.writelines(json.dumps(event) + "\n" for event in events)
+        except OSError as error:
+            logger.debug(f"Could not write trace events: {error}")
+
+    def merge(self, path: str):
+        """Write the spans of all processes as one Chrome trace to `path`."""
+        self.flush()
+        events = []
+        if os.path.isdir(self.directory):
+            for filename in sorted(os.listdir(self.directory)):
+                with open(os.path.join(self.directory, filename)) as f:
+                    events.extend(json.loads(line) for line in f if line.strip())
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        logger.info(f"Wrote {len(events)} trace events to {path}")
+
+
+def traced_call(worker: str, fn, element):
+    """Call `fn` in a process of a pool and record the call as a span."""
+    if _pool_tracer is None or not _pool_tracer.enabled:
+        return fn(element)
+    start = time.perf_counter()
+    try:
+        return fn(element)
+    finally:
+        _pool_tracer.span(worker, "subtask", start, time.perf_counter())
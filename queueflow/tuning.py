@@ -0,0 +1,152 @@
+import math
+import threading
+import time
+
+from .byte_queue import ResizableQueue
+from .logger import logger
+from .step_base import StepBase
+
+
+# Time the steps wait for the queue, by the direction of the items
+_BLOCKED = {"items_in": "get_blocked_time", "items_out": "put_blocked_time"}
+
+
+def _counters(step, field: str):
+    """Items and blocked time of a step, the output step of a `Sequence`
+    only counts the returned outputs."""
+    if isinstance(step, StepBase):
+        values = step.metrics.snapshot()
+        return values[field], values[_BLOCKED[field]]
+    return step.count_out, 0.0
+
+
+def _std(values) -> float:
+    mean = sum(values) / len(values)
+    return math.sqrt(sum((v - mean) ** 2 for v in values) / len(values))
+
+
+class QueueTuner:
+    """Chooses the sizes of the `ResizableQueue`s between the steps of a
+    `Sequence` from the rates observed while data flows.
+
+    During a warm-up window of `warmup` seconds the items put by the
+    producer and taken by the consumer of each queue are sampled every
+    `interval` seconds. Where the producer waited for space in the queue
+    and the consumer waited for elements, the rates fluctuate against each
+    other and a deeper queue absorbs the jitter: the queue is resized to
+    hold `z` standard deviations of the items per interval of both sides.
+    The new sizes are kept if the output rate of the sequence improves by
+    at least `min_gain` over a second window, otherwise they are reverted.
+    The result is logged, so it can be pinned with `queue_depths`."""
+
+    # Largest size the tuner gives to a queue
+    max_depth = 64
+
+    def __init__(
+        self,
+        qfseq,
+        warmup: float = 10.0,
+        interval: float = 0.1,
+        z: float = 2.0,
+        min_gain: float = 0.05,
+    ):
+        self.qfseq = qfseq
+        self.warmup = warmup
+        self.interval = interval
+        self.z = z
+        self.min_gain = min_gain
+        # Sizes of the inserted queues once tuned
+        self.depths = None
+        self.thread = threading.Thread(
+            target=self.run, daemon=True, args=(qfseq.shutdown_event,)
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def run(self, shutdown_event):
+        threading.current_thread().setName("queue tuner")
+        hops = self.qfseq.hops()
+        output = hops[-1][2]
+        tuned = [
+            hop
+            for hop in hops
+            if isinstance(hop[1], ResizableQueue)
+            and any(hop[1] is queue for queue in self.qfseq.inserted_queues)
+        ]
+        if not tuned:
+            return
+        # Start measuring once the first output arrived
+        while output.count_out == 0:
+            if shutdown_event.wait(self.interval):
+                return
+        rate, samples = self.__sample(tuned, output, shutdown_event)
+        if samples is None:
+            return
+        old = [queue._maxsize for _, queue, _ in tuned]
+        new = [
+            self.__depth(depth, consumer, s)
+            for depth, (_, _, consumer), s in zip(old, tuned, samples)
+        ]
+        if new == old:
+            self.__report("the queues absorb the jitter already")
+            return
+        for (_, queue, _), depth in zip(tuned, new):
+            queue.resize(depth)
+        new_rate, _ = self.__sample(tuned, output, shutdown_event)
+        if new_rate is None:
+            return
+        if new_rate < rate * (1 + self.min_gain):
+            for (_, queue, _), depth in zip(tuned, old):
+                queue.resize(depth)
+            self.__report(
+                f"resizing to {new} did not improve the output rate"
+                f" ({rate:.1f}/s to {new_rate:.1f}/s)",
+            )
+            return
+        self.__report(f"improved the output rate from {rate:.1f}/s to {new_rate:.1f}/s")
+
+    def __sample(self, tuned, output, shutdown_event):
+        """Output rate and for each queue the samples of the items put,
+        the items taken and the time both sides waited for the queue.
+        Returns None if the sequence stops or the data stops flowing."""
+        producers = [_counters(p, "items_out") for p, _, _ in tuned]
+        consumers = [_counters(c, "items_in") for _, _, c in tuned]
+        samples = [([], [], [0.0, 0.0]) for _ in tuned]
+        start, count_out = time.monotonic(), output.count_out
+        for _ in range(max(int(self.warmup / self.interval), 2)):
+            if shutdown_event.wait(self.interval):
+                return None, None
+            for i, (producer, _, consumer) in enumerate(tuned):
+                put, taken, blocked = samples[i]
+                new_producer = _counters(producer, "items_out")
+                new_consumer = _counters(consumer, "items_in")
+                put.append(new_producer[0] - producers[i][0])
+                taken.append(new_consumer[0] - consumers[i][0])
+                blocked[0] += new_producer[1] - producers[i][1]
+                blocked[1] += new_consumer[1] - consumers[i][1]
+                producers[i], consumers[i] = new_producer, new_consumer
+        if output.count_out == count_out:
+            logger.info("Queue tuner: no outputs during the window, not tuning.")
+            return None, None
+        rate = (output.count_out - count_out) / (time.monotonic() - start)
+        return rate, samples
+
+    def __depth(self, depth: int, consumer, samples) -> int:
+        put, taken, (put_blocked, get_blocked) = samples
+        if not sum(put) or not sum(taken):
+            return depth
+        # The output step does not report the time it waited
+        consumer_waited = get_blocked > 0 or not isinstance(consumer, StepBase)
+        if put_blocked <= 0 or not consumer_waited:
+            return depth
+        jitter = math.sqrt(_std(put) ** 2 + _std(taken) ** 2)
+        return min(max(depth, 1 + math.ceil(self.z * jitter)), self.max_depth)
+
+    def __report(self, result: str):
+        self.depths = [queue._maxsize for queue in self.qfseq.inserted_queues]
+        logger.info(
+            f"""\
+Queue tuner: {result}. Sizes of the inserted queues: {self.depths}, \
+pin them with Sequence(..., queue_depths={self.depths})."""
+        )
@@ -0,0 +1,22 @@
+import pytest
+
+import queueflow as qf
+from queueflow.shutdown_event import ShutdownEvent
+
+
+@pytest.fixture
+def sequence(monkeypatch):
+    """Builds and starts sequences, which are stopped after the test.
+    Each test gets a fresh shutdown event, as stopping a sequence sets it."""
+    monkeypatch.setattr(qf, "shutdown_event", ShutdownEvent())
+    sequences = []
+
+    def build(*steps, **kwargs):
+        seq = qf.Sequence(*steps, **kwargs)
+        sequences.append(seq)
+        seq.start()
+        return seq
+
+    yield build
+    for seq in sequences:
+        seq.stop()
@@ -0,0 +1,66 @@
+from functools import partial
+
+import pytest
+import torch
+
+import queueflow as qf
+
+
+def square(x):
+    return torch.full((4,), float(x * x))
+
+
+def scale(x, factor):
+    return x * factor
+
+
+def chunk(x):
+    return [x * 4 + i for i in range(4)]
+
+
+def test_cache_hits(sequence, tmp_path):
+    cache = qf.DiskCache(tmp_path, version="v1")
+    seq = sequence(qf.ProcessStep(square, 2, cache=cache))
+    for _ in range(2):
+        out = sorted(int(t[0]) for t in seq.queue_iterable(range(20)))
+        assert out == [x * x for x in range(20)]
+    metrics = seq.metrics()["steps"][0]
+    assert (metrics["cache_misses"], metrics["cache_hits"]) == (20, 20)
+
+
+def test_cache_separates_partials(tmp_path):
+    cache = qf.DiskCache(tmp_path)
+    double, triple = partial(scale, factor=2), partial(scale, factor=3)
+    assert cache.namespace(double) != cache.namespace(triple)
+    assert cache.namespace(double) == cache.namespace(partial(scale, factor=2))
+    with pytest.raises(TypeError):
+        cache.namespace(lambda x: x)
+
+
+def test_cache_unreadable_files(tmp_path):
+    cache = qf.DiskCache(tmp_path)
+    for i, value in enumerate([torch.arange(1000), torch.arange(1000)]):
+        cache[str(i)] = value
+    empty, truncated = sorted(tmp_path.glob("*/*.qfc"))
+    empty.write_bytes(b"")
+    truncated.write_bytes(truncated.read_bytes()[:-100])
+    for key in ("0", "1"):
+        with pytest.raises(KeyError):
+            cache[key]
+    assert not list(tmp_path.glob("*/*"))
+
+
+def test_cache_unreadable_files_are_processed(sequence, tmp_path):
+    cache = qf.DiskCache(tmp_path)
+    seq = sequence(
+        qf.ProcessStep(partial(scale, factor=1), 2, cache=cache),
+        qf.ProcessStep(chunk, 1),
+        qf.PoolStep(square, nworkers=2, cache=cache),
+    )
+    list(seq.queue_iterable(range(5)))
+    for path in tmp_path.glob("*/*.qfc"):
+        path.write_bytes(b"")
+    out = list(seq.queue_iterable(range(5)))
+    assert sorted(int(t[0]) for batch in out for t in batch) == [
+        x * x for x in range(20)
+    ]
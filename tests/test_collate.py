@@ -0,0 +1,20 @@
+import pytest
+import torch
+
+from queueflow.collate import default_collate
+
+
+def test_collate_fields():
+    batch = default_collate([{"x": torch.zeros(2), "y": (1, 2)}] * 3)
+    assert batch["x"].shape == (3, 2)
+    assert batch["y"][0].tolist() == [1, 1, 1]
+
+
+def test_collate_ragged():
+    with pytest.raises(ValueError, match="differing lengths"):
+        default_collate([[1, 2], [3]])
+
+
+def test_collate_differing_keys():
+    with pytest.raises(ValueError, match="differing keys"):
+        default_collate([{"a": 1}, {"a": 2, "b": 3}])
@@ -0,0 +1,45 @@
+import random
+import threading
+import time
+
+import queueflow as qf
+from queueflow.ordering import EpochGate
+from queueflow.terminate_queue import TerminateQueue
+
+
+def jitter(x):
+    time.sleep(random.random() * 0.002)
+    return x
+
+
+def test_epoch_boundaries(sequence):
+    # Several workers and a queue that buffers more than one element
+    seq = sequence(qf.ProcessStep(jitter, 3), queue_depths=[8])
+    for epoch in range(10):
+        elements = range(epoch * 40, epoch * 40 + 40)
+        assert sorted(seq.queue_iterable(elements)) == list(elements)
+
+
+def test_epochs_queued_ahead(sequence):
+    seq = sequence(qf.ProcessStep(jitter, 3))
+    for epoch in range(3):
+        seq.queue_iterable(range(epoch * 40, epoch * 40 + 40))
+    for epoch in range(3):
+        assert sorted(seq) == list(range(epoch * 40, epoch * 40 + 40))
+
+
+def test_crashed_putter():
+    gate = EpochGate(2)
+    # The worker in slot 1 takes the terminal element and crashes
+    # before it put it
+    _, terminals = gate.take(TerminateQueue(0), threading.Event(), 1)
+    assert [terminal.epoch for terminal in terminals] == [0]
+    put = []
+    epoch, _ = gate.take("x", threading.Event(), 0)
+    gate.finish(epoch, put.append, 0)
+    gate.take(TerminateQueue(1), threading.Event(), 0)
+    assert put == [] and not gate.is_open(1)
+    assert gate.release(1) == -1
+    gate.resume(put.append)
+    assert [terminal.epoch for terminal in put] == [0, 1]
+    assert gate.is_open(2)
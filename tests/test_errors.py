@@ -0,0 +1,154 @@
+import asyncio
+import os
+import signal
+import time
+from functools import partial
+
+import pytest
+
+import queueflow as qf
+
+
+def fail_on_sevens(x):
+    if x % 7 == 0:
+        raise ValueError(f"bad element {x}")
+    return x
+
+
+async def afail_on_sevens(x):
+    await asyncio.sleep(0.001)
+    return fail_on_sevens(x)
+
+
+def fail_once(directory, x):
+    """Fails on the first call for each element."""
+    marker = os.path.join(directory, str(x))
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        raise IOError(f"first call on {x}")
+    return x
+
+
+async def afail_once(directory, x):
+    await asyncio.sleep(0.001)
+    return fail_once(directory, x)
+
+
+def crash_once(marker, x):
+    if x == 13 and not os.path.exists(marker):
+        open(marker, "w").close()
+        os.kill(os.getpid(), signal.SIGKILL)
+    return x
+
+
+def chunk(x):
+    return list(range(x * 10, x * 10 + 10))
+
+
+def wait_for_dead_letters(seq, n):
+    # The dead letters are collected by a thread of the sequence
+    deadline = time.monotonic() + 5
+    while len(seq.dead_letters) < n and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def errors(seq, istep: int = 0) -> int:
+    return seq.metrics()["steps"][istep]["errors"]
+
+
+def test_skip(sequence):
+    seq = sequence(qf.ProcessStep(fail_on_sevens, 3, on_error="skip"))
+    for _ in range(2):
+        out = sorted(seq.queue_iterable(range(50)))
+        assert out == [x for x in range(50) if x % 7]
+    assert errors(seq) == 16
+
+
+def test_deadletter(sequence):
+    seq = sequence(qf.ProcessStep(fail_on_sevens, 3, on_error="deadletter"))
+    out = sorted(seq.queue_iterable(range(50)))
+    assert out == [x for x in range(50) if x % 7]
+    wait_for_dead_letters(seq, 8)
+    assert sorted(letter.element for letter in seq.dead_letters) == list(range(0, 50, 7))
+    assert errors(seq) == 8
+
+
+def test_pool_policies(sequence):
+    seq = sequence(
+        qf.ProcessStep(chunk, 1),
+        qf.PoolStep(fail_on_sevens, nworkers=2, on_error="deadletter"),
+    )
+    out = list(seq.queue_iterable(range(5)))
+    assert sorted(x for batch in out for x in batch) == [x for x in range(50) if x % 7]
+    wait_for_dead_letters(seq, 8)
+    assert sorted(letter.element for letter in seq.dead_letters) == list(range(0, 50, 7))
+    assert errors(seq, 1) == 8
+
+
+def test_async_step_skip(sequence):
+    seq = sequence(qf.AsyncStep(afail_on_sevens, 2, on_error="skip"))
+    out = sorted(seq.queue_iterable(range(50)))
+    assert out == [x for x in range(50) if x % 7]
+    assert errors(seq) == 8
+
+
+def test_retries(sequence, tmp_path):
+    directories = [tmp_path / name for name in ("process", "pool", "async")]
+    for directory in directories:
+        directory.mkdir()
+    seq = sequence(
+        qf.ProcessStep(partial(fail_once, str(directories[0])), 3, retries=1),
+        qf.ProcessStep(chunk, 1),
+        qf.PoolStep(partial(fail_once, str(directories[1])), nworkers=2, retries=1),
+        qf.UnpackStep(),
+        qf.AsyncStep(partial(afail_once, str(directories[2])), 1, retries=1),
+    )
+    assert sorted(seq.queue_iterable(range(5))) == list(range(50))
+    assert [step["errors"] for step in seq.metrics()["steps"]] == [0] * 5
+
+
+def test_max_tasks(sequence):
+    seq = sequence(
+        qf.ProcessStep(fail_on_sevens, 2, max_tasks=4, on_error="skip"),
+        qf.ProcessStep(chunk, 1),
+        qf.PoolStep(fail_on_sevens, nworkers=2, max_tasks=3, on_error="skip"),
+    )
+    for _ in range(2):
+        out = list(seq.queue_iterable(range(30)))
+        kept = [x for x in range(30) if x % 7]
+        assert sorted(x for batch in out for x in batch) == [
+            x for k in kept for x in chunk(k) if x % 7
+        ]
+    metrics = seq.metrics()["steps"]
+    assert metrics[0]["errors"] == 10 and metrics[0]["respawns"] >= 10
+    assert metrics[2]["errors"] == sum(1 for k in kept for x in chunk(k) if x % 7 == 0) * 2
+
+
+def test_respawn(sequence, tmp_path):
+    marker = str(tmp_path / "crashed")
+    seq = sequence(qf.ProcessStep(partial(crash_once, marker), 3, on_error="skip"))
+    # The element the worker crashed on is lost
+    assert sorted(seq.queue_iterable(range(50))) == [x for x in range(50) if x != 13]
+    assert sorted(seq.queue_iterable(range(50))) == list(range(50))
+    metrics = seq.metrics()["steps"][0]
+    assert (metrics["errors"], metrics["respawns"]) == (1, 1)
+
+
+def test_crash_deadletter(sequence, tmp_path):
+    marker = str(tmp_path / "crashed")
+    seq = sequence(
+        qf.ProcessStep(partial(crash_once, marker), 3, on_error="deadletter")
+    )
+    assert sorted(seq.queue_iterable(range(50))) == [x for x in range(50) if x != 13]
+    wait_for_dead_letters(seq, 1)
+    (letter,) = seq.dead_letters
+    assert letter.element is None and "exited with code -9" in letter.error
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_crash_raise(sequence, tmp_path):
+    marker = str(tmp_path / "crashed")
+    seq = sequence(qf.ProcessStep(partial(crash_once, marker), 3))
+    # The crash stops the sequence
+    assert len(list(seq.queue_iterable(range(50)))) < 50
+    assert seq.shutdown_event.is_set()
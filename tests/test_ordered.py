@@ -0,0 +1,52 @@
+import asyncio
+import random
+import time
+
+import pytest
+from torch import multiprocessing as mp
+
+import queueflow as qf
+
+
+def jitter(x):
+    time.sleep(random.random() * 0.002)
+    return x
+
+
+async def ajitter(x):
+    await asyncio.sleep(random.random() * 0.002)
+    return x
+
+
+def test_ordered(sequence):
+    seq = sequence(qf.ProcessStep(jitter, 3), ordered=True)
+    for _ in range(3):
+        assert list(seq.queue_iterable(range(60))) == list(range(60))
+
+
+def test_ordered_async_step(sequence):
+    seq = sequence(qf.AsyncStep(ajitter, 1, concurrency=8), ordered=True)
+    assert list(seq.queue_iterable(range(60))) == list(range(60))
+
+
+def test_ordered_async_step_needs_one_worker():
+    with pytest.raises(ValueError):
+        qf.Sequence(qf.AsyncStep(ajitter, 2), ordered=True)
+
+
+def test_ordered_remote_step():
+    step = qf.RemoteStep(jitter, address=("127.0.0.1", 0), authkey=b"secret")
+    with pytest.raises(ValueError):
+        qf.Sequence(step, ordered=True)
+
+
+def test_ordered_repack_buckets():
+    step = qf.RepackStep(mp.Value("i", 4), cost_fn=len, budget=8, buckets=[2])
+    with pytest.raises(ValueError):
+        qf.Sequence(step, ordered=True)
+
+
+def test_ordered_parallel_merge():
+    step = qf.Parallel([qf.ProcessStep(jitter, 2)], [], join="merge")
+    with pytest.raises(ValueError):
+        qf.Sequence(step, ordered=True)
@@ -0,0 +1,28 @@
+import queueflow as qf
+
+
+def double(x):
+    return 2 * x
+
+
+def negate(x):
+    return -x
+
+
+def test_branch_steps_in_metrics(sequence):
+    seq = sequence(
+        qf.Parallel(
+            qf.ProcessStep(double, 2, name="double"),
+            qf.ProcessStep(negate, 1, name="negate"),
+        )
+    )
+    for _ in range(2):
+        assert list(seq.queue_iterable(range(20))) == [(2 * x, -x) for x in range(20)]
+    steps = {step["name"]: step for step in seq.metrics()["steps"]}
+    assert steps["double"]["items_out"] == steps["negate"]["items_out"] == 40
+
+
+def test_branch_steps_autoscaled():
+    step = qf.ProcessStep(double, 1, max_workers=3)
+    seq = qf.Sequence(qf.Parallel([step], []), autoscale=True)
+    assert seq.autoscaler.scalable_steps() == [step]
@@ -0,0 +1,64 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import queueflow as qf
+
+
+def slow_fail_on_sevens(x):
+    time.sleep(0.01)
+    if x % 7 == 0:
+        raise ValueError(f"bad element {x}")
+    return x
+
+
+def start_workers(address, nworkers: int):
+    """Start `python -m queueflow.remote_worker` on localhost, the worker
+    function is imported from this module."""
+    host, port = address
+    tests = Path(__file__).parent
+    env = dict(
+        os.environ,
+        QUEUEFLOW_AUTHKEY="secret",
+        PYTHONPATH=os.pathsep.join([str(tests), str(tests.parent)]),
+    )
+    return subprocess.Popen(
+        [sys.executable, "-m", "queueflow.remote_worker", f"{host}:{port}"]
+        + ["--nworkers", str(nworkers)],
+        env=env,
+        stderr=subprocess.DEVNULL,
+        # Killed together with its workers
+        start_new_session=True,
+    )
+
+
+def test_remote_workers(sequence):
+    step = qf.RemoteStep(
+        slow_fail_on_sevens,
+        address=("127.0.0.1", 0),
+        authkey=b"secret",
+        on_error="skip",
+    )
+    seq = sequence(step)
+    workers = [start_workers(step.address, 2) for _ in range(2)]
+    try:
+        expected = [x for x in range(60) if x % 7]
+        for epoch in range(2):
+            out = []
+            for x in seq.queue_iterable(range(60)):
+                out.append(x)
+                # Elements in flight on the lost workers are resent
+                if epoch == 0 and len(out) == 10:
+                    os.killpg(workers[0].pid, signal.SIGKILL)
+            assert sorted(out) == expected
+        assert seq.metrics()["steps"][0]["errors"] == 18
+    finally:
+        for worker in workers:
+            try:
+                os.killpg(worker.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            worker.wait()
@@ -0,0 +1,22 @@
+import pytest
+import torch
+
+import queueflow as qf
+
+
+def full(x):
+    return torch.full((3,), float(x))
+
+
+@pytest.mark.parametrize("ownership", [None, "move"])
+def test_replay_is_not_aliased(sequence, ownership):
+    seq = sequence(qf.ProcessStep(full, 2), ordered=True, ownership=ownership)
+    seq.queue_iterable(range(5), record=True)
+    for out in seq:
+        out.mul_(100)
+    for _ in range(2):
+        seq.queue_replay()
+        outs = list(seq)
+        assert [out[0].item() for out in outs] == [0.0, 1.0, 2.0, 3.0, 4.0]
+        for out in outs:
+            out.mul_(100)
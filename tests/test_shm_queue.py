@@ -0,0 +1,55 @@
+from functools import partial
+
+import numpy as np
+
+import queueflow as qf
+from queueflow.terminate_queue import TerminateQueue
+
+
+def arange(n):
+    return np.arange(n, dtype=np.float32)
+
+
+def test_slot_round_trip():
+    q = qf.ShmQueue(2, slot_size=1024)
+    q.put({"x": arange(64), "y": arange(8)})
+    # Both arrays were written into one slot
+    assert q._slot_used[:] == [1, 0]
+    out = q.get()
+    assert q._slot_used[:] == [0, 0]
+    np.testing.assert_array_equal(out["x"], arange(64))
+    np.testing.assert_array_equal(out["y"], arange(8))
+    # The arrays are copies of the slot, writing them is allowed
+    out["x"][0] = -1
+    q.close()
+
+
+def test_inline_fallback():
+    q = qf.ShmQueue(3, slot_size=1024)
+    # Without out-of-band buffers and larger than the slot
+    q.put({"a": [1, 2]})
+    q.put(arange(1024))
+    q.put(TerminateQueue(3))
+    assert q._slot_used[:] == [0, 0, 0]
+    assert q.get() == {"a": [1, 2]}
+    np.testing.assert_array_equal(q.get(), arange(1024))
+    terminal = q.get()
+    assert isinstance(terminal, TerminateQueue) and terminal.epoch == 3
+    q.close()
+
+
+def test_sequence_epochs(sequence):
+    seq = sequence(
+        qf.ProcessStep(arange, 2),
+        queue_type=partial(qf.ShmQueue, slot_size=2**12),
+        queue_depths=[4],
+    )
+    for epoch in range(3):
+        # Arrays through the slots and arrays larger than a slot
+        sizes = [16, 2048] * 10
+        outputs = sorted(seq.queue_iterable(sizes), key=len)
+        assert [len(out) for out in outputs] == sorted(sizes)
+        for out in outputs:
+            np.testing.assert_array_equal(out, arange(len(out)))
+    assert seq.queue_status()[1] == (0, 4)
+    assert all(queue._slot_used[:] == [0] * 4 for queue in seq.inserted_queues)